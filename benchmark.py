@@ -0,0 +1,974 @@
+"""
+Бенчмарки Food Scanner Bot
+
+Примеры запуска:
+    # Размер запроса и задержка в зависимости от уменьшения фото (нужен WORKFLOW_URL / ROBOFLOW_API_KEY)
+    python benchmark.py preprocess ./photos --sides 0,1280,1024,800,640 --qualities 90,80,70
+
+    # Задержка текстового поиска продуктов на синтетической базе
+    python benchmark.py lookup --sizes 35,10000,100000
+
+    # Пропускная способность webhook-сервера с локальным фейковым Telegram
+    python benchmark.py webhook --updates 2000 --concurrency 40
+
+    # Память и задержка на фото для режимов визуализации (локальный фейковый Workflow API)
+    python benchmark.py visualization --photos 50 --visualization-kb 1500
+
+    # Пропускная способность локального детектора при разном размере батча (офлайн, модель dummy)
+    python benchmark.py detector --model dummy --batch-sizes 1,4,8 --photos 200
+
+    # Нагрузочный тест обработчиков (фото + текст) и сравнение с прошлым прогоном
+    python benchmark.py load --updates 1000 --save base.json
+    python benchmark.py load --updates 1000 --baseline base.json
+"""
+import io
+import os
+import sys
+import math
+import time
+import asyncio
+import json
+import argparse
+import csv
+import random
+import base64
+import tempfile
+import logging
+import resource
+import subprocess
+import tracemalloc
+import multiprocessing
+import statistics
+
+import aiohttp
+from aiohttp import web
+from PIL import Image
+from telegram import Update
+
+import bot_with_photo as bot
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+# ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
+def percentile(values, q):
+    """Перцентиль q (0-100) по списку значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def parse_int_list(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+def print_table(headers, rows):
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    print("  ".join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
+
+def load_images(folder):
+    images = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(folder, name), "rb") as f:
+                images.append((name, f.read()))
+    return images
+
+def class_agreement(reference, candidate):
+    """Точность и полнота набора классов относительно эталона (оригинального фото)"""
+    if not reference and not candidate:
+        return 1.0, 1.0
+    common = len(reference & candidate)
+    precision = common / len(candidate) if candidate else 0.0
+    recall = common / len(reference) if reference else 0.0
+    return precision, recall
+
+
+# ========== ПОДГОТОВКА ИЗОБРАЖЕНИЙ ==========
+async def bench_preprocess(args):
+    """Размер запроса, задержка и качество распознавания для разных max side / JPEG quality"""
+    images = load_images(args.images)
+    if not images:
+        print(f"❌ В папке {args.images} нет изображений")
+        return 1
+
+    # Кэш мешает измерениям — отключаем
+    bot.inference_cache = bot.InferenceCache(max_entries=0, directory="")
+    await bot.inference_client.start()
+
+    variants = []
+    for side in parse_int_list(args.sides):
+        if side == 0:
+            variants.append((0, None))  # оригинал без перекодирования
+        else:
+            variants.extend((side, quality) for quality in parse_int_list(args.qualities))
+
+    reference = {}
+    rows = []
+    try:
+        for side, quality in variants:
+            payloads, prepare_times, latencies, precisions, recalls = [], [], [], [], []
+            for name, data in images:
+                for _ in range(args.repeats):
+                    started = time.perf_counter()
+                    prepared = data if side == 0 else await bot.prepare_image(data, side, quality)
+                    prepared_at = time.perf_counter()
+                    result = await bot.detect_food_in_photo(prepared)
+                    finished = time.perf_counter()
+
+                    prepare_times.append((prepared_at - started) * 1000)
+                    latencies.append((finished - started) * 1000)
+                    # base64 раздувает тело запроса на треть
+                    payloads.append((len(prepared) + 2) // 3 * 4)
+
+                    foods = {f["name"] for f in result["foods"]} if result else set()
+                    # Эталон — первый вариант из списка (обычно оригинал, side=0)
+                    reference.setdefault(name, foods)
+                    precision, recall = class_agreement(reference[name], foods)
+                    precisions.append(precision)
+                    recalls.append(recall)
+
+            rows.append((
+                "оригинал" if side == 0 else side,
+                "-" if quality is None else quality,
+                f"{statistics.mean(payloads) / 1024:.0f}",
+                f"{statistics.mean(prepare_times):.1f}",
+                f"{percentile(latencies, 50):.0f}",
+                f"{percentile(latencies, 95):.0f}",
+                f"{statistics.mean(precisions):.2f}",
+                f"{statistics.mean(recalls):.2f}",
+            ))
+    finally:
+        await bot.inference_client.close()
+
+    print(f"\nИзображений: {len(images)}, повторов: {args.repeats}, эталон: {variants[0]}")
+    print_table(
+        ["max side", "quality", "payload KB", "prepare ms", "p50 ms", "p95 ms", "precision", "recall"],
+        rows
+    )
+    return 0
+
+
+# ========== ТЕКСТОВЫЙ ПОИСК ==========
+# Слоги для синтетических названий: (русский, латиница)
+SYLLABLES = [
+    ("ба", "ba"), ("бо", "bo"), ("ве", "ve"), ("ви", "vi"), ("га", "ga"), ("гу", "gu"), ("да", "da"),
+    ("до", "do"), ("жа", "zha"), ("зе", "ze"), ("зо", "zo"), ("ка", "ka"), ("ки", "ki"), ("ко", "ko"),
+    ("ку", "ku"), ("ла", "la"), ("ле", "le"), ("ли", "li"), ("лу", "lu"), ("ма", "ma"), ("ме", "me"),
+    ("ми", "mi"), ("мо", "mo"), ("на", "na"), ("не", "ne"), ("ни", "ni"), ("но", "no"), ("па", "pa"),
+    ("пе", "pe"), ("по", "po"), ("ра", "ra"), ("ре", "re"), ("ри", "ri"), ("ро", "ro"), ("ру", "ru"),
+    ("са", "sa"), ("се", "se"), ("си", "si"), ("со", "so"), ("та", "ta"), ("те", "te"), ("ти", "ti"),
+    ("то", "to"), ("ту", "tu"), ("фа", "fa"), ("фи", "fi"), ("ха", "ha"), ("хо", "ho"), ("ца", "tsa"),
+    ("че", "che"), ("чи", "chi"), ("ша", "sha"), ("шо", "sho"), ("щу", "schu"), ("ю", "yu"), ("я", "ya"),
+    ("ль", "l"), ("рн", "rn"), ("ск", "sk"), ("ст", "st"), ("нт", "nt"), ("вк", "vk"),
+]
+
+def synthetic_database(size, seed=42):
+    """База из size продуктов со случайными названиями из 1-3 слов (плюс настоящие продукты)"""
+    rng = random.Random(seed)
+    database = {}
+    with open(bot.FOOD_CSV_PATH, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            database[row["name"]] = {"ru": row["ru"], "calories": row["calories"], "protein": row["protein"],
+                                     "fat": row["fat"], "carbs": row["carbs"], "aliases": row["aliases"]}
+    while len(database) < size:
+        parts = [[rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))] for _ in range(rng.randint(1, 3))]
+        en = " ".join("".join(en for _, en in word) for word in parts)
+        ru = " ".join("".join(ru for ru, _ in word) for word in parts)
+        if en not in database:
+            database[en] = {"ru": ru, "calories": rng.randint(1, 600), "protein": 1.0, "fat": 1.0, "carbs": 1.0,
+                            "aliases": ""}
+    return database
+
+def write_food_csv(database, path):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "ru", "calories", "protein", "fat", "carbs", "aliases"])
+        for name, info in database.items():
+            writer.writerow([name, info["ru"], info["calories"], info["protein"], info["fat"], info["carbs"],
+                             info["aliases"]])
+
+def legacy_lookup(database, text):
+    """Старый поиск из handle_text: линейный проход по базе"""
+    for eng_name, food_info in database.items():
+        if text in food_info["ru"] or text == eng_name:
+            return eng_name
+    similar = []
+    for eng_name, food_info in database.items():
+        if text in food_info["ru"] or any(word in food_info["ru"] for word in text.split()):
+            similar.append(food_info["ru"])
+    return similar[:5] or None
+
+def make_typo(word, rng):
+    if len(word) < 4:
+        return word + "а"
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1:]
+
+def time_queries(func, queries, repeats):
+    timings = []
+    for _ in range(repeats):
+        for query in queries:
+            started = time.perf_counter()
+            func(query)
+            timings.append((time.perf_counter() - started) * 1e6)
+    return timings
+
+async def bench_lookup(args):
+    """Задержка поиска по индексу и старым линейным проходом на базах разного размера"""
+    rng = random.Random(7)
+    rows = []
+    workdir = tempfile.mkdtemp(prefix="food-bench-")
+    for size in parse_int_list(args.sizes):
+        database = synthetic_database(size)
+        csv_path = os.path.join(workdir, f"foods-{size}.csv")
+        write_food_csv(database, csv_path)
+        # Загрузка как в боте: CSV -> SQLite -> индекс названий (строки читаются по требованию)
+        started = time.perf_counter()
+        food_db = bot.FoodDatabase(os.path.join(workdir, f"foods-{size}.sqlite"), csv_path)
+        load_ms = (time.perf_counter() - started) * 1000
+
+        def search(query):
+            key = food_db.index.lookup(query)
+            if key is not None:
+                return food_db.get(key)
+            return [food_db.get(k) for k in food_db.index.suggest(query)]
+
+        names = [info["ru"] for info in rng.sample(list(database.values()), min(args.queries, len(database)))]
+        workloads = {
+            "точное": names,
+            "начало слова": [name.split()[0][:4] for name in names],
+            "опечатка": [make_typo(name.split()[0], rng) for name in names],
+            "нет в базе": [f"щщ{i}ъъ" for i in range(len(names))],
+        }
+        for kind, queries in workloads.items():
+            indexed = time_queries(search, queries, args.repeats)
+            legacy = time_queries(lambda q: legacy_lookup(database, q), queries[:args.legacy_queries], 1)
+            rows.append((
+                size, kind, f"{load_ms:.0f}",
+                f"{percentile(indexed, 50):.1f}", f"{percentile(indexed, 99):.1f}",
+                f"{percentile(legacy, 50):.1f}", f"{percentile(legacy, 99):.1f}",
+            ))
+
+    print(f"\nЗапросов: {args.queries} x {args.repeats}, время в микросекундах")
+    print_table(["size", "запрос", "load ms", "index p50", "index p99", "linear p50", "linear p99"], rows)
+    return 0
+
+
+# ========== ФЕЙКОВЫЙ WORKFLOW API ==========
+class FakeWorkflowServer:
+    """Локальная имитация Roboflow Workflow API с настраиваемой задержкой и размером визуализации"""
+
+    def __init__(self, latency=0.0, visualization_kb=500, predictions=3):
+        self.latency = latency
+        self.visualization = base64.b64encode(os.urandom(visualization_kb * 1024 * 3 // 4)).decode("ascii")
+        self.predictions = [
+            {"class": name, "confidence": 0.9 - i * 0.1, "x": 100 + 50 * i, "y": 100, "width": 80, "height": 60,
+             "class_id": i, "detection_id": f"det-{i}"}
+            for i, name in enumerate(["apple", "banana", "pizza", "salad", "rice"][:predictions])
+        ]
+        self.requests = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self._runner = None
+        self.port = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}/workflow"
+
+    async def _handle(self, request):
+        body = await request.read()
+        self.requests += 1
+        self.request_bytes += len(body)
+        payload = json.loads(body)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = {"predictions": self.predictions}
+        if "visualization" not in payload.get("excluded_fields", ()):
+            result["visualization"] = self.visualization
+        response = web.json_response([result])
+        self.response_bytes += len(response.body)
+        return response
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/workflow", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# ========== ФЕЙКОВЫЙ TELEGRAM ==========
+class FakeTelegramServer:
+    """Локальная имитация Bot API: отвечает ok на вызовы методов, отдает файлы и запоминает время ответов бота"""
+
+    def __init__(self, token="123456:BENCH", latency=0.0, photo_kb=150):
+        self.token = token
+        self.latency = latency
+        self.photo_kb = photo_kb
+        self.photo = b""
+        self.calls = {}
+        self.replies = {}  # chat_id -> время первого сообщения бота
+        self.finished = {}  # chat_id -> время последнего сообщения или правки (итоговый ответ)
+        self._message_id = 0
+        self._runner = None
+        self.port = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def base_file_url(self):
+        return f"http://127.0.0.1:{self.port}/file/bot"
+
+    def _message(self, chat_id, **fields):
+        self._message_id += 1
+        message = {"message_id": self._message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}}
+        message.update(fields or {"text": "ok"})
+        return message
+
+    def _photo_message(self, chat_id):
+        file_id = f"sent-{self._message_id + 1}"
+        return self._message(chat_id, photo=[
+            {"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}
+        ])
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getFile":
+            file_id = params["file_id"]
+            file_path = f"photos/{file_id}.jpg"
+            result = {"file_id": file_id, "file_unique_id": file_id,
+                      "file_size": len(self.photo) + len(file_path.encode()), "file_path": file_path}
+        elif method == "sendChatAction":
+            result = True
+        elif method.startswith("send"):
+            self.replies.setdefault(chat_id, time.perf_counter())
+            self.finished[chat_id] = time.perf_counter()
+            if method == "sendPhoto":
+                result = self._photo_message(chat_id)
+            elif method == "sendMediaGroup":
+                media = params.get("media") or []
+                if isinstance(media, str):
+                    media = json.loads(media)
+                result = [self._photo_message(chat_id) for _ in media]
+            else:
+                result = self._message(chat_id)
+        elif method == "editMessageText":
+            self.finished[chat_id] = time.perf_counter()
+            result = self._message(chat_id)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _file(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # Хвост после JPEG делает каждый файл уникальным (иначе кэш по хэшу содержимого
+        # превратит все фото после первого в попадания), а декодеры его игнорируют
+        return web.Response(body=self.photo + request.match_info["path"].encode(), content_type="image/jpeg")
+
+    async def start(self):
+        self.photo = noise_photo(self.photo_kb)
+        # Альбом с разметкой (sendMediaGroup) — несколько фото в одном multipart-запросе
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+def text_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        },
+    }
+
+
+def photo_update(update_id, chat_id, file_key, width=1280, height=960, media_group_id=None):
+    """Фото с тремя размерами превью, как их присылает Telegram"""
+    photo = [
+        {"file_id": f"{file_key}-{w}", "file_unique_id": f"{file_key}-{w}", "width": w, "height": h}
+        for w, h in ((width // 4, height // 4), (width // 2, height // 2), (width, height))
+    ]
+    update = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "photo": photo,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        },
+    }
+    if media_group_id:
+        update["message"]["media_group_id"] = media_group_id
+    return update
+
+# ========== WEBHOOK ==========
+async def bench_webhook(args):
+    """Фейковый Telegram шлет апдейты в webhook-сервер бота; меряем прием и время до ответа"""
+    telegram = FakeTelegramServer()
+    await telegram.start()
+    application = bot.build_application(telegram.token, base_url=telegram.base_url)
+    secret = "bench-secret"
+    runner = web.AppRunner(bot.build_web_app(application, secret=secret), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{bot.WEBHOOK_PATH}"
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    sent_at = {}
+    ingest = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def deliver(i):
+                async with semaphore:
+                    chat_id = 1000 + i
+                    started = time.perf_counter()
+                    sent_at[chat_id] = started
+                    async with session.post(url, json=text_update(i + 1, chat_id, args.text), headers=headers) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            raise RuntimeError(f"webhook ответил {resp.status}")
+                    ingest.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(deliver(i) for i in range(args.updates)))
+            accepted = time.perf_counter() - started
+            # Ждем, пока бот ответит на все апдейты
+            while len(telegram.replies) < args.updates and time.perf_counter() - started < args.timeout:
+                await asyncio.sleep(0.01)
+            finished = time.perf_counter() - started
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        await telegram.stop()
+
+    end_to_end = [(telegram.replies[c] - t) * 1000 for c, t in sent_at.items() if c in telegram.replies]
+    print(f"\nАпдейтов: {args.updates}, параллельно: {args.concurrency}, UPDATE_WORKERS: {bot.UPDATE_WORKERS}")
+    print_table(
+        ["метрика", "значение"],
+        [
+            ("принято, апд/с", f"{args.updates / accepted:.0f}"),
+            ("обработано, апд/с", f"{len(end_to_end) / finished:.0f}"),
+            ("прием p50 ms", f"{percentile(ingest, 50):.1f}"),
+            ("прием p99 ms", f"{percentile(ingest, 99):.1f}"),
+            ("до ответа p50 ms", f"{percentile(end_to_end, 50):.1f}"),
+            ("до ответа p99 ms", f"{percentile(end_to_end, 99):.1f}"),
+            ("без ответа", args.updates - len(end_to_end)),
+        ]
+    )
+    return 0
+
+
+# ========== ВИЗУАЛИЗАЦИЯ ==========
+def noise_photo(kb):
+    """JPEG из шума примерно заданного размера (шум плохо сжимается, как и настоящие фото)"""
+    side = max(64, int(math.sqrt(kb * 1024 * 1.6)))
+    img = Image.effect_noise((side, side * 3 // 4), 64).convert("RGB")
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=bot.IMAGE_JPEG_QUALITY)
+    return out.getvalue()
+
+async def visualization_pass(photos, with_visualization, output):
+    """Распознает фото и получает картинку с разметкой (decode — серверную, render — локальную); задержки в мс"""
+    latencies = []
+    for photo_bytes in photos:
+        started = time.perf_counter()
+        result = await bot.detect_food_in_photo(photo_bytes, with_visualization=with_visualization)
+        if output == "decode" and result and result.get("visualization"):
+            bot.decode_visualization(result["visualization"])
+        elif output == "render" and result and result.get("boxes"):
+            await bot.box_renderer.render(photo_bytes, result["boxes"])
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+async def visualization_peak_memory(photos, with_visualization, output):
+    """Пиковый прирост памяти (tracemalloc) на одно фото, в КБ"""
+    peaks = []
+    for photo_bytes in photos:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await visualization_pass([photo_bytes], with_visualization, output)
+        peaks.append((tracemalloc.get_traced_memory()[1] - baseline) / 1024)
+    return peaks
+
+async def bench_visualization(args):
+    """Сравнение режимов визуализации: local, inline, none и on_demand (с нажатием кнопки и без)"""
+    workflow = FakeWorkflowServer(latency=args.latency / 1000, visualization_kb=args.visualization_kb)
+    await workflow.start()
+    bot.inference_client.url = workflow.url
+    await bot.inference_client.start()
+    bot.box_renderer.start()
+
+    # Разные фото и отключенный кэш — каждый вызов идет в Workflow API
+    photos = [noise_photo(args.photo_kb) for _ in range(args.photos)]
+    modes = [
+        ("local", False, "render"),
+        ("inline", True, "decode"),
+        ("none", False, None),
+        ("on_demand (без нажатия)", False, None),
+        ("on_demand (нажатие)", False, "render"),
+    ]
+    rows = []
+    try:
+        for name, with_visualization, output in modes:
+            bot.inference_cache = bot.InferenceCache(max_entries=0, directory="")
+            workflow.response_bytes = 0
+            latencies = await visualization_pass(photos, with_visualization, output)
+            response_kb = workflow.response_bytes / len(photos) / 1024
+
+            tracemalloc.start()
+            peaks = await visualization_peak_memory(photos[:args.memory_photos], with_visualization, output)
+            tracemalloc.stop()
+
+            rows.append((
+                name, f"{response_kb:.0f}",
+                f"{percentile(latencies, 50):.1f}", f"{percentile(latencies, 99):.1f}",
+                f"{statistics.mean(peaks):.0f}",
+            ))
+    finally:
+        bot.box_renderer.stop()
+        await bot.inference_client.close()
+        await workflow.stop()
+
+    print(f"\nФото: {args.photos} x {args.photo_kb} КБ, визуализация: {args.visualization_kb} КБ base64, "
+          f"задержка API: {args.latency:.0f} мс")
+    print_table(["режим", "ответ КБ", "p50 ms", "p99 ms", "пик памяти КБ"], rows)
+    print("on_demand на фото в среднем = без нажатия + доля нажатий x нажатие")
+    return 0
+
+
+# ========== ЛОКАЛЬНЫЙ ДЕТЕКТОР ==========
+async def bench_detector(args):
+    """Локальный детектор: пропускная способность и задержка в зависимости от размера батча"""
+    photos = [noise_photo(args.photo_kb) for _ in range(args.photos)]
+    rows = []
+    for batch_size in parse_int_list(args.batch_sizes):
+        detector = bot.LocalDetector(model_path=args.model, workers=args.workers, batch_size=batch_size)
+        await detector.start()
+        if not detector.available:
+            return 1
+        try:
+            # Прогрев: загрузка модели в процессах пула
+            await asyncio.gather(*(detector.detect(photo, False) for photo in photos[:args.workers]))
+            detector.batches.clear()
+
+            semaphore = asyncio.Semaphore(args.concurrency)
+            latencies = []
+
+            async def detect(photo_bytes):
+                async with semaphore:
+                    started = time.perf_counter()
+                    await detector.detect(photo_bytes, False)
+                    latencies.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(detect(photo) for photo in photos))
+            elapsed = time.perf_counter() - started
+        finally:
+            await detector.stop()
+
+        passes = sum(detector.batches.values())
+        rows.append((
+            batch_size, f"{len(photos) / elapsed:.1f}", f"{len(photos) / passes:.1f}",
+            f"{percentile(latencies, 50):.1f}", f"{percentile(latencies, 99):.1f}",
+        ))
+
+    print(f"\nМодель: {args.model}, фото: {args.photos} x {args.photo_kb} КБ, "
+          f"процессов: {args.workers}, параллельно: {args.concurrency}")
+    print_table(["батч", "фото/с", "фото на проход", "p50 ms", "p99 ms"], rows)
+    return 0
+
+
+# ========== НАГРУЗОЧНЫЙ ТЕСТ ==========
+LOAD_QUERIES = ["яблоко", "банан 150 г", "курица", "пицца 2 куска", "гречка", "кофе с молоком", "абракадабра"]
+
+# Метрики для сравнения с базовым прогоном: True — чем больше, тем лучше
+LOAD_METRICS = {
+    "throughput": True,
+    "photo_p50_ms": False,
+    "photo_p99_ms": False,
+    "text_p50_ms": False,
+    "text_p99_ms": False,
+    "album_p50_ms": False,
+    "album_p99_ms": False,
+    "loop_lag_p99_ms": False,
+    "loop_lag_max_ms": False,
+    "peak_rss_mb": False,
+    "rss_growth_mb": False,
+    "telegram_calls_per_update": False,
+    "errors": False,
+    "unanswered": False,
+}
+
+def serve_fakes(conn, telegram_options, workflow_options):
+    """Фейковые Telegram и Workflow API в отдельном процессе: они не делят с ботом event loop и память"""
+    async def run():
+        telegram = FakeTelegramServer(**telegram_options)
+        workflow = FakeWorkflowServer(**workflow_options)
+        await telegram.start()
+        await workflow.start()
+        conn.send((telegram.port, workflow.port))
+        # На каждую команду отдаем счетчики; "stop" — последняя
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None, conn.recv)
+            # Время ответов — в time.time(): perf_counter разных процессов сравнивать нельзя
+            offset = time.time() - time.perf_counter()
+            conn.send({
+                "calls": telegram.calls, "replied": len(telegram.replies),
+                "finished": {chat: at + offset for chat, at in telegram.finished.items()},
+                "workflow_requests": workflow.requests,
+            })
+            if command == "stop":
+                break
+        await telegram.stop()
+        await workflow.stop()
+    asyncio.run(run())
+
+def current_rss_mb():
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def watch_loop_lag(samples, interval=0.01):
+    """Задержка event loop: насколько позже запланированного просыпается sleep, в мс"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append((time.perf_counter() - started - interval) * 1000)
+
+def synthetic_updates(count, photo_share, repeat_share, seed, first_id=1, album_share=0.0, album_size=10):
+    """Смесь фото и текстов; доля repeat_share фото повторяет уже отправленные (попадания в кэш),
+    доля album_share фото приходит альбомами по album_size (каждое фото — отдельный апдейт)"""
+    rng = random.Random(seed)
+    updates = []
+    sent_photos = []
+    i = first_id
+    while i < first_id + count:
+        chat_id = 100000 + i
+        if rng.random() < photo_share:
+            if rng.random() < album_share:
+                size = min(album_size, first_id + count - i)
+                group = f"album{seed}-{i}"
+                for k in range(size):
+                    updates.append(("album", photo_update(i + k, chat_id, f"{group}-{k}", media_group_id=group)))
+                i += size
+                continue
+            if sent_photos and rng.random() < repeat_share:
+                file_key = rng.choice(sent_photos)
+            else:
+                file_key = f"photo{seed}-{i}"
+                sent_photos.append(file_key)
+            updates.append(("photo", photo_update(i, chat_id, file_key)))
+        else:
+            updates.append(("text", text_update(i, chat_id, rng.choice(LOAD_QUERIES))))
+        i += 1
+    return updates
+
+async def drive_updates(application, updates, concurrency, rate):
+    """Прогоняет апдейты через обработчики Application; задержка — до завершения обработчика, в мс.
+    При rate > 0 апдейты приходят с постоянной частотой и задержка считается от запланированного
+    времени прихода, иначе держим concurrency апдейтов в работе одновременно.
+    Фото альбома обработчик только откладывает в сборщик, поэтому для альбомов возвращаем
+    время (time.time) доставки последнего фото по чатам — ответ ждет вызывающий"""
+    latencies = {"photo": [], "text": []}
+    album_sent = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def deliver(kind, data, arrival):
+        update = Update.de_json(data, application.bot)
+        if rate:
+            await application.update_processor.process_update(update, application.process_update(update))
+        else:
+            async with semaphore:
+                arrival = time.perf_counter()
+                await application.update_processor.process_update(update, application.process_update(update))
+        if kind == "album":
+            chat_id = data["message"]["chat"]["id"]
+            album_sent[chat_id] = max(album_sent.get(chat_id, 0.0), time.time())
+        else:
+            latencies[kind].append((time.perf_counter() - arrival) * 1000)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, (kind, data) in enumerate(updates):
+        arrival = started + i / rate if rate else started
+        if rate:
+            await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+        tasks.append(asyncio.create_task(deliver(kind, data, arrival)))
+    await asyncio.gather(*tasks)
+    return latencies, album_sent, time.perf_counter() - started
+
+def wait_for_albums(conn, album_sent, timeout):
+    """Ждет итоговых ответов на альбомы у фейкового Telegram; задержки от последнего фото, в мс"""
+    deadline = time.time() + timeout
+    while True:
+        conn.send("stats")
+        finished = conn.recv()["finished"]
+        answered = {chat: finished[chat] for chat in album_sent if chat in finished}
+        if len(answered) == len(album_sent) or time.time() >= deadline:
+            return [(at - album_sent[chat]) * 1000 for chat, at in answered.items()]
+        time.sleep(0.05)
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare_with_baseline(report, baseline, tolerance):
+    """Печатает изменения относительно базового прогона; возвращает список регрессий"""
+    if baseline.get("params") != report["params"]:
+        print("⚠️ Параметры базового прогона отличаются — сравнение может быть некорректным")
+    rows = []
+    regressions = []
+    for name, higher_is_better in LOAD_METRICS.items():
+        old, new = baseline["metrics"].get(name), report["metrics"].get(name)
+        if old is None or new is None:
+            continue
+        if old:
+            change = (new - old) / abs(old)
+        else:
+            change = 0.0 if new == old else math.inf
+        worse = -change if higher_is_better else change
+        mark = "регрессия" if worse > tolerance else ("лучше" if worse < -tolerance else "")
+        if mark == "регрессия":
+            regressions.append(name)
+        rows.append((name, f"{old:.1f}", f"{new:.1f}", f"{change * 100:+.0f}%", mark))
+    print(f"\nСравнение с {baseline.get('revision') or 'базой'} (допуск {tolerance * 100:.0f}%)")
+    print_table(["метрика", "база", "сейчас", "изменение", ""], rows)
+    return regressions
+
+async def bench_load(args):
+    """Нагрузочный тест: настоящие обработчики, фейковые Telegram и Workflow API в отдельном процессе"""
+    ctx = multiprocessing.get_context("spawn")
+    conn, child_conn = ctx.Pipe()
+    fakes = ctx.Process(target=serve_fakes, daemon=True, args=(
+        child_conn,
+        {"latency": args.telegram_latency / 1000, "photo_kb": args.photo_kb},
+        {"latency": args.workflow_latency / 1000, "visualization_kb": args.visualization_kb,
+         "predictions": args.predictions},
+    ))
+    fakes.start()
+    telegram_port, workflow_port = conn.recv()
+
+    # Строка лога на каждый апдейт сама по себе нагрузка и заслоняет результат
+    logging.disable(logging.INFO)
+    token = "123456:BENCH"
+    bot.inference_client.url = f"http://127.0.0.1:{workflow_port}/workflow"
+    bot.inference_cache = bot.InferenceCache(directory="")
+    diary_dir = tempfile.TemporaryDirectory()
+    bot.meal_diary = bot.MealDiary(path=os.path.join(diary_dir.name, "diary.sqlite"))
+    application = bot.build_application(
+        token,
+        base_url=f"http://127.0.0.1:{telegram_port}/bot",
+        base_file_url=f"http://127.0.0.1:{telegram_port}/file/bot",
+    )
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(context.error)
+    application.add_error_handler(count_error)
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    lag = []
+    try:
+        # Прогрев: пул соединений, шрифты, пул отрисовки
+        warmup = synthetic_updates(args.warmup, args.photo_share, 0, seed=args.seed + 1, first_id=10 ** 6)
+        await drive_updates(application, warmup, args.concurrency, 0)
+        errors.clear()
+        calls_before = sum(bot.telegram_api_totals.calls.values())
+
+        updates = synthetic_updates(args.updates, args.photo_share, args.repeat_share, seed=args.seed,
+                                    album_share=args.album_share, album_size=args.album_size)
+        rss_before = current_rss_mb()
+        watcher = asyncio.create_task(watch_loop_lag(lag))
+        started = time.perf_counter()
+        latencies, album_sent, _ = await drive_updates(application, updates, args.concurrency, args.rate)
+        # Альбомы отвечают после окна сборки — ждем их в потоке, чтобы event loop бота работал
+        latencies["album"] = await asyncio.to_thread(wait_for_albums, conn, album_sent, args.timeout)
+        elapsed = time.perf_counter() - started
+        watcher.cancel()
+        telegram_calls = sum(bot.telegram_api_totals.calls.values()) - calls_before
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        conn.send("stop")
+        fake_stats = conn.recv()
+        fakes.join(timeout=5)
+        diary_dir.cleanup()
+
+    metrics = {
+        "throughput": len(updates) / elapsed,
+        "photo_p50_ms": percentile(latencies["photo"], 50),
+        "photo_p99_ms": percentile(latencies["photo"], 99),
+        "text_p50_ms": percentile(latencies["text"], 50),
+        "text_p99_ms": percentile(latencies["text"], 99),
+        "album_p50_ms": percentile(latencies["album"], 50),
+        "album_p99_ms": percentile(latencies["album"], 99),
+        "loop_lag_p99_ms": percentile(lag, 99),
+        "loop_lag_max_ms": max(lag, default=0.0),
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": max(0.0, peak_rss_mb() - rss_before),
+        "telegram_calls_per_update": telegram_calls / len(updates),
+        "errors": len(errors),
+        # Ответ — один на чат (альбом — один ответ на все фото); прогрев тоже получает ответы
+        "unanswered": len({data["message"]["chat"]["id"] for _, data in warmup + updates}) - fake_stats["replied"],
+    }
+    report = {
+        "revision": git_revision(),
+        "params": {
+            name: getattr(args, name) for name in (
+                "updates", "concurrency", "rate", "photo_share", "repeat_share", "album_share", "album_size", "photo_kb",
+                "visualization_kb", "predictions", "telegram_latency", "workflow_latency", "seed",
+            )
+        },
+        "bot": {
+            "visualization_mode": bot.VISUALIZATION_MODE, "detector_backends": bot.DETECTOR_BACKENDS,
+            "update_workers": bot.UPDATE_WORKERS, "stream_uploads": bot.STREAM_UPLOADS,
+        },
+        "metrics": metrics,
+    }
+
+    photos = len(latencies["photo"])
+    album_photos = sum(1 for kind, _ in updates if kind == "album")
+    print(f"\nАпдейтов: {len(updates)} (фото: {photos}, в альбомах: {album_photos} / {len(album_sent)} альбомов, "
+          f"текст: {len(updates) - photos - album_photos}), "
+          f"{f'{args.rate:.0f} апд/с' if args.rate else f'параллельно: {args.concurrency}'}, "
+          f"задержка Telegram: {args.telegram_latency:.0f} мс, Workflow API: {args.workflow_latency:.0f} мс")
+    print(f"Визуализация: {bot.VISUALIZATION_MODE}, детекторы: {','.join(bot.DETECTOR_BACKENDS)}, "
+          f"запросов в Workflow API: {fake_stats['workflow_requests']}")
+    print_table(["метрика", "значение"], [(name, f"{value:.1f}") for name, value in metrics.items()])
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен в {args.save}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare_with_baseline(report, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+# ========== ЗАПУСК ==========
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки Food Scanner Bot")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("preprocess", help="уменьшение фото перед отправкой в детектор")
+    p.add_argument("images", help="папка с тестовыми фото еды")
+    p.add_argument("--sides", default="0,1280,1024,800,640", help="max side через запятую, 0 — оригинал")
+    p.add_argument("--qualities", default="90,80,70", help="JPEG quality через запятую")
+    p.add_argument("--repeats", type=int, default=1)
+    p.set_defaults(func=bench_preprocess)
+
+    p = sub.add_parser("lookup", help="текстовый поиск продуктов (FoodIndex против линейного прохода)")
+    p.add_argument("--sizes", default="35,10000,100000", help="размеры синтетической базы через запятую")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--legacy-queries", type=int, default=50, help="запросов для медленного линейного поиска")
+    p.set_defaults(func=bench_lookup)
+
+    p = sub.add_parser("webhook", help="webhook-сервер с локальным фейковым Telegram")
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=40, help="одновременных запросов (как max_connections)")
+    p.add_argument("--text", default="яблоко", help="текст сообщений (по умолчанию — поиск продукта)")
+    p.add_argument("--timeout", type=float, default=60)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser("visualization", help="режимы визуализации: память и задержка на фото")
+    p.add_argument("--photos", type=int, default=50)
+    p.add_argument("--photo-kb", type=int, default=150, help="размер отправляемого фото")
+    p.add_argument("--visualization-kb", type=int, default=1500, help="размер визуализации в ответе (base64)")
+    p.add_argument("--latency", type=float, default=0, help="задержка фейкового Workflow API, мс")
+    p.add_argument("--memory-photos", type=int, default=10, help="фото для замера памяти (tracemalloc медленный)")
+    p.set_defaults(func=bench_visualization)
+
+    p = sub.add_parser("detector", help="локальный детектор: микробатчинг в пуле процессов")
+    p.add_argument("--model", default="dummy", help="путь к ONNX-модели или dummy")
+    p.add_argument("--batch-sizes", default="1,4,8", help="размеры батча через запятую")
+    p.add_argument("--photos", type=int, default=200)
+    p.add_argument("--photo-kb", type=int, default=150)
+    p.add_argument("--workers", type=int, default=1, help="процессов с моделью")
+    p.add_argument("--concurrency", type=int, default=32, help="одновременных запросов на распознавание")
+    p.set_defaults(func=bench_detector)
+
+    p = sub.add_parser("load", help="нагрузочный тест обработчиков с фейковыми Telegram и Workflow API")
+    p.add_argument("--updates", type=int, default=1000)
+    p.add_argument("--concurrency", type=int, default=64, help="апдейтов в работе одновременно")
+    p.add_argument("--rate", type=float, default=0, help="апдейтов в секунду (открытая нагрузка), 0 — по concurrency")
+    p.add_argument("--photo-share", type=float, default=0.5, help="доля фото среди апдейтов")
+    p.add_argument("--repeat-share", type=float, default=0.1, help="доля повторно присланных фото")
+    p.add_argument("--album-share", type=float, default=0.1, help="доля фото, присланных альбомами")
+    p.add_argument("--album-size", type=int, default=10, help="фото в альбоме (в Telegram до 10)")
+    p.add_argument("--timeout", type=float, default=60, help="сколько ждать ответов на альбомы, сек")
+    p.add_argument("--photo-kb", type=int, default=150, help="размер фото, которое отдает фейковый Telegram")
+    p.add_argument("--visualization-kb", type=int, default=500, help="размер визуализации в ответе (base64)")
+    p.add_argument("--predictions", type=int, default=3, help="объектов в ответе Workflow API")
+    p.add_argument("--telegram-latency", type=float, default=30, help="задержка фейкового Telegram, мс")
+    p.add_argument("--workflow-latency", type=float, default=300, help="задержка фейкового Workflow API, мс")
+    p.add_argument("--warmup", type=int, default=20)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--save", help="сохранить результат в JSON")
+    p.add_argument("--baseline", help="JSON прошлого прогона для сравнения; код выхода 1 при регрессии")
+    p.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение метрики (доля)")
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    return asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
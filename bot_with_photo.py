@@ -3,145 +3,2533 @@ import logging
 import asyncio
 import tempfile
 import json
-import requests
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+import time
+import hashlib
+import contextvars
+import hmac
+import signal
+import secrets
+import bisect
+import csv
+import sqlite3
+import functools
+import contextlib
+import zlib
+import random
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import heapq
+import math
+from collections import Counter, OrderedDict, deque
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlsplit
+import httpx
+from aiohttp import web
+from prometheus_client import Counter as PromCounter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from telegram import Update, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ChatAction
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from io import BytesIO
-import base64
+import binascii
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+# numpy и onnxruntime нужны только локальному детектору (DETECTOR_BACKENDS=local)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx пишет каждый запрос вместе с access_key в query — оставляем только предупреждения
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # ========== НАСТРОЙКИ API ==========
 ROBOFLOW_API_KEY = os.getenv("ROBOFLOW_API_KEY", "pxdm5gsSa9zxNzhvq4oX")
 WORKSPACE_NAME = "kalori-lsshy"
 WORKFLOW_ID = "detect-count-and-visualize"
 
-# Workflow API endpoint
-WORKFLOW_URL = f"https://serverless.roboflow.com/workflow/{WORKFLOW_ID}"
+# Workflow API endpoint (можно переопределить, например, на локальный стаб-сервер)
+WORKFLOW_URL = os.getenv("WORKFLOW_URL", f"https://serverless.roboflow.com/workflow/{WORKFLOW_ID}")
+
+# Пул соединений к Workflow API
+ROBOFLOW_MAX_CONNECTIONS = int(os.getenv("ROBOFLOW_MAX_CONNECTIONS", "20"))
+ROBOFLOW_MAX_KEEPALIVE = int(os.getenv("ROBOFLOW_MAX_KEEPALIVE", "10"))
+ROBOFLOW_KEEPALIVE_EXPIRY = float(os.getenv("ROBOFLOW_KEEPALIVE_EXPIRY", "30"))
+ROBOFLOW_HOST_CONCURRENCY = int(os.getenv("ROBOFLOW_HOST_CONCURRENCY", "8"))
+ROBOFLOW_CONNECT_TIMEOUT = float(os.getenv("ROBOFLOW_CONNECT_TIMEOUT", "5"))
+ROBOFLOW_TIMEOUT = float(os.getenv("ROBOFLOW_TIMEOUT", "30"))
+
+# Кэш результатов распознавания
+INFERENCE_CACHE_MAX_ENTRIES = int(os.getenv("INFERENCE_CACHE_MAX_ENTRIES", "512"))
+INFERENCE_CACHE_MAX_BYTES = int(os.getenv("INFERENCE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+INFERENCE_CACHE_TTL = float(os.getenv("INFERENCE_CACHE_TTL", str(7 * 24 * 3600)))
+INFERENCE_CACHE_DIR = os.getenv("INFERENCE_CACHE_DIR", "")  # пусто — без дискового кэша
+INFERENCE_CACHE_DISK_MAX_BYTES = int(os.getenv("INFERENCE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+INFERENCE_CACHE_PRUNE_INTERVAL = float(os.getenv("INFERENCE_CACHE_PRUNE_INTERVAL", "600"))  # 0 — только при старте
+
+# Подготовка изображения перед отправкой в детектор
+DETECTOR_INPUT_SIZE = int(os.getenv("DETECTOR_INPUT_SIZE", "640"))  # входное разрешение модели
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))  # больше — уменьшаем через Pillow
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+# Фото, которое не нужно уменьшать, передаем из Telegram в Workflow API потоком
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "1") == "1"
+STREAM_CHUNK_SIZE = 48 * 1024  # кратно 3 — base64 кусков склеивается без перекодирования
+# Скачивание из Telegram — через свой пул: иначе потоковые скачивания займут все соединения пула Workflow API
+TELEGRAM_DOWNLOAD_CONNECTIONS = int(os.getenv("TELEGRAM_DOWNLOAD_CONNECTIONS", "32"))
+ALBUM_CONCURRENCY = int(os.getenv("ALBUM_CONCURRENCY", "3"))  # фото одного альбома в работе одновременно
+
+# Детекторы: remote — Roboflow Workflow API, local — ONNX-модель на CPU.
+# Порядок задает приоритет и failover: "remote,local" — удаленный, при сбое локальный
+DETECTOR_BACKENDS = [
+    name.strip() for name in os.getenv("DETECTOR_BACKENDS", "remote").lower().split(",") if name.strip()
+]
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "")  # "dummy" — встроенная модель для офлайн-тестов
+ONNX_LABELS_PATH = os.getenv("ONNX_LABELS_PATH", "")  # класс на строку, по умолчанию <модель>.txt
+LOCAL_DETECTOR_WORKERS = int(os.getenv("LOCAL_DETECTOR_WORKERS", "1"))  # процессов с моделью
+LOCAL_BATCH_SIZE = int(os.getenv("LOCAL_BATCH_SIZE", "8"))  # фото в одном проходе модели
+LOCAL_BATCH_WAIT = float(os.getenv("LOCAL_BATCH_WAIT", "0.02"))  # ожидание добора батча, сек
+LOCAL_CONFIDENCE = 0.25  # предварительный порог до NMS (итоговый 40% — как для Workflow API)
+LOCAL_IOU = 0.5
+
+# Устойчивость вызова Workflow API
+DETECT_DEADLINE = float(os.getenv("DETECT_DEADLINE", "25"))  # общий лимит на распознавание с повторами, сек
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))  # всего попыток
+RETRY_BACKOFF_BASE = 0.25  # сек, удваивается с каждой попыткой (full jitter)
+RETRY_BACKOFF_MAX = 4.0
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))  # повторов не больше 20% от запросов
+RETRY_BUDGET_MIN = 5  # ...но столько повторов за окно разрешено всегда (при малом трафике)
+RETRY_BUDGET_WINDOW = 10.0  # сек
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # неудач подряд до размыкания
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))  # сек до пробного запроса
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "0") == "1"  # дубль запроса, если ответ дольше p95
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20  # без статистики задержек дубли не отправляем
+
+# Очередь распознавания
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", "4"))  # одновременных распознаваний
+INFERENCE_QUEUE_MAX = int(os.getenv("INFERENCE_QUEUE_MAX", "100"))  # больше — отказываем
+INFERENCE_CANCEL_STALE = os.getenv("INFERENCE_CANCEL_STALE", "1") == "1"  # новое фото отменяет старое
+
+# База продуктов: исходный CSV собирается в SQLite-файл, который читается через mmap
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FOOD_CSV_PATH = os.getenv("FOOD_CSV_PATH", os.path.join(BASE_DIR, "foods.csv"))
+FOOD_DB_PATH = os.getenv("FOOD_DB_PATH", os.path.join(BASE_DIR, "foods.sqlite"))
+FOOD_DB_MMAP_SIZE = int(os.getenv("FOOD_DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+FOOD_DB_CACHE_SIZE = int(os.getenv("FOOD_DB_CACHE_SIZE", "4096"))  # строк в LRU-кэше
+FOOD_DB_RELOAD_INTERVAL = float(os.getenv("FOOD_DB_RELOAD_INTERVAL", "30"))  # 0 — без горячей перезагрузки
+
+# Дневник питания: SQLite в режиме WAL, пишет одна фоновая задача пачками
+DIARY_DB_PATH = os.getenv("DIARY_DB_PATH", os.path.join(BASE_DIR, "diary.sqlite"))  # пусто — без дневника
+DIARY_BATCH_SIZE = int(os.getenv("DIARY_BATCH_SIZE", "200"))  # записей в одной транзакции
+DIARY_FLUSH_INTERVAL = float(os.getenv("DIARY_FLUSH_INTERVAL", "0.5"))  # сек ожидания пачки
+DIARY_QUEUE_MAX = int(os.getenv("DIARY_QUEUE_MAX", "10000"))  # больше — записи отбрасываются
+DIARY_UTC_OFFSET = float(os.getenv("DIARY_UTC_OFFSET", "3"))  # часовой пояс границы суток, часы от UTC
+
+# Альбомы: фото с одним media_group_id приходят отдельными апдейтами
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.0"))  # тишина после последнего фото, сек
+MEDIA_GROUP_MAX_WAIT = float(os.getenv("MEDIA_GROUP_MAX_WAIT", "5.0"))  # максимум ожидания альбома, сек
+
+# Визуализация: local — рамки рисуем сами по предсказаниям, inline — картинка с разметкой
+# от Workflow API в каждом ответе, on_demand — локальная разметка по кнопке, none — без разметки
+VISUALIZATION_MODE = os.getenv("VISUALIZATION_MODE", "local").lower()
+VISUALIZATION_CALLBACK = "visualize"
+CAPTION_MAX_LENGTH = 1024  # лимит Telegram на подпись к фото (в UTF-16)
+
+# Локальная отрисовка рамок
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+FONT_PATH = os.getenv("FONT_PATH", "")  # TrueType-шрифт с кириллицей
+MAX_RENDER_BOXES = 50
+
+# Индикация прогресса: сначала только "печатает..." / "отправляет фото...",
+# статусное сообщение — если обработка затянулась
+PROGRESS_MESSAGE_DELAY = float(os.getenv("PROGRESS_MESSAGE_DELAY", "3.0"))  # сек до первого статуса
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "1.5"))  # минимум между правками, сек
+CHAT_ACTION_INTERVAL = 4.5  # Telegram показывает действие 5 секунд
+
+# Сколько апдейтов обрабатывается одновременно
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))
+
+# Режим работы: polling (long polling) или webhook (встроенный HTTP-сервер)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных запросов от Telegram
+WEBHOOK_MAX_BODY = 1024 * 1024
+# Сбрасывать ли накопившиеся апдейты при регистрации webhook: при нескольких инстансах
+# перезапуск любого из них иначе терял бы апдейты всего бота
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"
+
+# Служебный сервер с подробным /healthz и /metrics: отдельный порт, не публичный webhook (0 — не запускать).
+# На публичном порту webhook есть только статусный /healthz для балансировщика
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # 0.0.0.0 — только во внутренней сети
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LOG_TRACE_IDS = os.getenv("LOG_TRACE_IDS", "0") == "1"  # trace id апдейта в каждой строке лога
+
+# ========== МЕТРИКИ И ТРАССИРОВКА ==========
+class UpdateStats:
+    """Обработка одного апдейта: trace id, время по этапам, вызовы Bot API"""
+
+    def __init__(self, trace_id="-"):
+        self.trace_id = trace_id
+        self.calls = Counter()
+        self.seconds = 0.0
+        self.stages = Counter()
+        self.started = time.perf_counter()
+
+    def record(self, method, seconds):
+        self.calls[method] += 1
+        self.seconds += seconds
+
+    def summary(self):
+        methods = ", ".join(f"{method}×{count}" for method, count in self.calls.most_common())
+        return f"{sum(self.calls.values())} вызовов, {self.seconds * 1000:.0f} мс ({methods or 'нет'})"
+
+    def stage_summary(self):
+        return ", ".join(f"{stage} {seconds * 1000:.0f}" for stage, seconds in self.stages.items()) or "без этапов"
+
+
+# Статистика текущего апдейта (наследуется фоновыми задачами и задачами очереди) и общая по Bot API
+update_stats = contextvars.ContextVar("update_stats", default=None)
+telegram_api_totals = UpdateStats()
+
+class TraceIdFilter(logging.Filter):
+    """Подставляет в запись лога trace id апдейта, в рамках которого она сделана"""
+
+    def filter(self, record):
+        stats = update_stats.get()
+        record.trace_id = stats.trace_id if stats is not None else "-"
+        return True
+
+if LOG_TRACE_IDS:
+    for log_handler in logging.getLogger().handlers:
+        log_handler.addFilter(TraceIdFilter())
+        log_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - [%(trace_id)s] - %(levelname)s - %(message)s'
+        ))
+
+# До 30 секунд — столько максимум ждет пользователь
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+STAGE_SECONDS = Histogram(
+    "foodbot_stage_seconds", "Время этапов обработки фото", ["stage"], buckets=STAGE_BUCKETS
+)
+HANDLER_SECONDS = Histogram(
+    "foodbot_handler_seconds", "Время обработки апдейта целиком", ["handler"], buckets=STAGE_BUCKETS
+)
+STAGE_ERRORS = PromCounter("foodbot_stage_errors", "Исключения по этапам обработки", ["stage"])
+PREDICTIONS = PromCounter(
+    "foodbot_predictions", "Предсказания детектора: прошли порог уверенности или отброшены", ["result"]
+)
+
+def record_stage(stage, seconds):
+    """Учитывает длительность этапа в гистограмме и в разбивке текущего апдейта"""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    stats = update_stats.get()
+    if stats is not None:
+        stats.stages[stage] += seconds
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Замеряет этап обработки; исключения считаются в foodbot_stage_errors"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+class BotStateCollector:
+    """Счетчики и очереди, которые уже ведут компоненты бота, — читаются в момент запроса /metrics"""
+
+    def __init__(self):
+        self.application = None
+
+    def describe(self):
+        # Без describe() REGISTRY вызывает collect() при регистрации — до создания компонентов
+        return []
+
+    def collect(self):
+        cache = CounterMetricFamily("foodbot_inference_cache", "События кэша распознавания", labels=["event"])
+        for event, value in inference_cache.stats.items():
+            cache.add_metric([event], value)
+        yield cache
+        
+        scheduler = CounterMetricFamily("foodbot_inference_jobs", "Задачи очереди распознавания", labels=["event"])
+        for event, value in inference_scheduler.stats.items():
+            scheduler.add_metric([event], value)
+        yield scheduler
+        
+        detections = CounterMetricFamily("foodbot_detections", "Ответы детекторов", labels=["result"])
+        for result, value in detector_router.stats.items():
+            detections.add_metric([result], value)
+        yield detections
+        
+        events = CounterMetricFamily(
+            "foodbot_detector_events", "Запросы, повторы, дубли и срабатывания предохранителя", labels=["detector", "event"]
+        )
+        breakers = GaugeMetricFamily(
+            "foodbot_breaker_state", "Состояние предохранителя (1 — текущее)", labels=["detector", "state"]
+        )
+        for detector in detector_router.detectors:
+            for event, value in getattr(detector, "stats", {}).items():
+                events.add_metric([detector.name, event], value)
+            if detector.breaker:
+                for event, value in detector.breaker.stats.items():
+                    events.add_metric([detector.name, f"breaker_{event}"], value)
+                for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+                    breakers.add_metric([detector.name, state], 1 if detector.breaker.state == state else 0)
+        yield events
+        yield breakers
+        
+        calls = CounterMetricFamily("foodbot_telegram_calls", "Вызовы Telegram Bot API", labels=["method"])
+        for method, value in telegram_api_totals.calls.items():
+            calls.add_metric([method], value)
+        yield calls
+        yield CounterMetricFamily(
+            "foodbot_telegram_seconds", "Суммарное время в вызовах Telegram Bot API", value=telegram_api_totals.seconds
+        )
+        
+        queues = GaugeMetricFamily("foodbot_queue_depth", "Глубина очередей", labels=["queue"])
+        queues.add_metric(["inference"], inference_scheduler.depth)
+        queues.add_metric(["inference_busy"], inference_scheduler.busy)
+        queues.add_metric(["diary"], meal_diary.depth)
+        if self.application is not None:
+            queues.add_metric(["updates"], self.application.update_queue.qsize())
+        yield queues
+        
+        yield GaugeMetricFamily("foodbot_cache_entries", "Записей в памяти кэша", value=len(inference_cache._entries))
+        
+        diary = CounterMetricFamily("foodbot_diary_events", "Записи дневника питания", labels=["event"])
+        for event, value in meal_diary.stats.items():
+            diary.add_metric([event], value)
+        yield diary
+
+
+metrics_collector = BotStateCollector()
+REGISTRY.register(metrics_collector)
+
+# ========== ПОИСКОВЫЙ ИНДЕКС ПРОДУКТОВ ==========
+def normalize_query(text):
+    """Нижний регистр, ё → е, без знаков препинания и лишних пробелов"""
+    text = text.lower().replace("ё", "е")
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in text).split())
+
+def _trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class FoodIndex:
+    """Индекс для текстового поиска: точные названия, инвертированный индекс слов, нечеткий поиск по триграммам"""
+
+    def __init__(self, entries=()):
+        self._exact = {}  # полное название (en / ru / синоним) -> ключ продукта
+        self._tokens = {}  # слово -> set(ключей)
+        self._trigram_postings = {}  # триграмма -> set(слов)
+        self._trigram_counts = {}  # слово -> число его триграмм
+        self._sorted_tokens = []
+        self._order = {}  # ключ -> порядковый номер в базе (для стабильного ранжирования)
+        self.build(entries)
+
+    def build(self, entries):
+        """Строит индекс заново по парам (ключ продукта, его названия)"""
+        self._exact.clear()
+        self._tokens.clear()
+        self._trigram_postings.clear()
+        self._trigram_counts.clear()
+        self._order.clear()
+        for position, (key, names) in enumerate(entries):
+            self._order[key] = position
+            for name in names:
+                name = normalize_query(name)
+                if not name:
+                    continue
+                self._exact.setdefault(name, key)
+                for token in name.split():
+                    self._tokens.setdefault(token, set()).add(key)
+        # Триграммы строим по словарю слов, а не по названиям: слов меньше и опечатки — внутри слов
+        for token in self._tokens:
+            trigrams = _trigrams(token)
+            self._trigram_counts[token] = len(trigrams)
+            for trigram in trigrams:
+                self._trigram_postings.setdefault(trigram, set()).add(token)
+        self._sorted_tokens = sorted(self._tokens)
+
+    def __len__(self):
+        return len(self._order)
+
+    def _prefix_keys(self, prefix):
+        """Ключи продуктов, у которых есть слово, начинающееся с prefix"""
+        keys = set()
+        tokens = self._sorted_tokens
+        i = bisect.bisect_left(tokens, prefix)
+        while i < len(tokens) and tokens[i].startswith(prefix):
+            keys |= self._tokens[tokens[i]]
+            i += 1
+        return keys
+
+    def lookup(self, query):
+        """Ключ продукта по запросу: точное название или все слова запроса совпали (в т.ч. по началу слова)"""
+        query = normalize_query(query)
+        if not query:
+            return None
+        key = self._exact.get(query)
+        if key is not None:
+            return key
+        candidates = None
+        for token in query.split():
+            keys = self._prefix_keys(token)
+            candidates = keys if candidates is None else candidates & keys
+            if not candidates:
+                return None
+        return min(candidates, key=self._order.__getitem__)
+
+    def suggest(self, query, limit=5, min_score=0.3):
+        """Похожие продукты, отсортированные по убыванию сходства"""
+        query = normalize_query(query)
+        if not query:
+            return []
+        scores = {}
+        tokens = query.split()
+
+        # Нечеткий поиск по словам: коэффициент Дайса по триграммам (устойчив к опечаткам).
+        # Общие триграммы считаем одним проходом Counter по спискам слов для каждой триграммы
+        for token in tokens:
+            query_trigrams = _trigrams(token)
+            # Меньше `needed` общих триграмм — min_score недостижим при любой длине слова
+            needed = max(1, math.ceil(min_score * len(query_trigrams) / (2 - min_score)))
+            shared = Counter()
+            for trigram in query_trigrams:
+                shared.update(self._trigram_postings.get(trigram, ()))
+            best = {}
+            for word, common in shared.items():
+                if common < needed:
+                    continue
+                score = 2 * common / (len(query_trigrams) + self._trigram_counts[word])
+                if score < min_score:
+                    continue
+                for key in self._tokens[word]:
+                    if score > best.get(key, 0):
+                        best[key] = score
+            # Итоговое сходство — среднее по словам запроса
+            for key, score in best.items():
+                scores[key] = scores.get(key, 0) + score / len(tokens)
+
+        # Совпадение слова запроса (или его начала) поднимает продукт в выдаче
+        for token in tokens:
+            keys = self._tokens.get(token, set()) if len(token) < 3 else self._prefix_keys(token)
+            for key in keys:
+                scores[key] = scores.get(key, 0) + 0.5
+
+        return heapq.nsmallest(
+            limit,
+            (key for key, score in scores.items() if score >= min_score),
+            key=lambda k: (-scores[k], self._order[k])
+        )
+
 
 # ========== БАЗА ПРОДУКТОВ ==========
-FOOD_DATABASE = {
-    "apple": {"ru": "яблоко", "calories": 52, "protein": 0.3, "fat": 0.2, "carbs": 14},
-    "banana": {"ru": "банан", "calories": 89, "protein": 1.1, "fat": 0.3, "carbs": 23},
-    "orange": {"ru": "апельсин", "calories": 47, "protein": 0.9, "fat": 0.1, "carbs": 12},
-    "pizza": {"ru": "пицца", "calories": 266, "protein": 11, "fat": 10, "carbs": 33},
-    "hamburger": {"ru": "гамбургер", "calories": 295, "protein": 17, "fat": 14, "carbs": 24},
-    "sandwich": {"ru": "сэндвич", "calories": 250, "protein": 10, "fat": 8, "carbs": 30},
-    "salad": {"ru": "салат", "calories": 15, "protein": 1, "fat": 0.2, "carbs": 3},
-    "chicken": {"ru": "курица", "calories": 239, "protein": 27, "fat": 14, "carbs": 0},
-    "rice": {"ru": "рис", "calories": 130, "protein": 2.7, "fat": 0.3, "carbs": 28},
-    "bread": {"ru": "хлеб", "calories": 265, "protein": 9, "fat": 3.2, "carbs": 49},
-    "egg": {"ru": "яйцо", "calories": 155, "protein": 13, "fat": 11, "carbs": 1},
-    "milk": {"ru": "молоко", "calories": 42, "protein": 3.4, "fat": 1, "carbs": 5},
-    "cheese": {"ru": "сыр", "calories": 402, "protein": 25, "fat": 33, "carbs": 1},
-    "pasta": {"ru": "паста", "calories": 131, "protein": 5, "fat": 1, "carbs": 25},
-    "fish": {"ru": "рыба", "calories": 206, "protein": 22, "fat": 12, "carbs": 0},
-    "carrot": {"ru": "морковь", "calories": 41, "protein": 0.9, "fat": 0.2, "carbs": 10},
-    "tomato": {"ru": "помидор", "calories": 18, "protein": 0.9, "fat": 0.2, "carbs": 3.9},
-    "potato": {"ru": "картофель", "calories": 77, "protein": 2, "fat": 0.1, "carbs": 17},
-    "cake": {"ru": "торт", "calories": 350, "protein": 4, "fat": 15, "carbs": 50},
-    "ice cream": {"ru": "мороженое", "calories": 207, "protein": 3.5, "fat": 11, "carbs": 24},
-    "chocolate": {"ru": "шоколад", "calories": 546, "protein": 4.9, "fat": 31, "carbs": 61},
-    "coffee": {"ru": "кофе", "calories": 2, "protein": 0.1, "fat": 0, "carbs": 0},
-    "tea": {"ru": "чай", "calories": 1, "protein": 0, "fat": 0, "carbs": 0},
-    "soup": {"ru": "суп", "calories": 50, "protein": 3, "fat": 2, "carbs": 6},
-    "fries": {"ru": "картофель фри", "calories": 312, "protein": 3.4, "fat": 15, "carbs": 41},
-    "steak": {"ru": "стейк", "calories": 271, "protein": 26, "fat": 19, "carbs": 0},
-    "pork": {"ru": "свинина", "calories": 242, "protein": 25, "fat": 14, "carbs": 0},
-    "beef": {"ru": "говядина", "calories": 250, "protein": 26, "fat": 15, "carbs": 0},
-    "shrimp": {"ru": "креветки", "calories": 85, "protein": 18, "fat": 0.9, "carbs": 0.2},
-    "sushi": {"ru": "суши", "calories": 150, "protein": 5, "fat": 0.5, "carbs": 30},
-    "donut": {"ru": "пончик", "calories": 452, "protein": 5, "fat": 25, "carbs": 51},
-    "cookie": {"ru": "печенье", "calories": 502, "protein": 5, "fat": 24, "carbs": 65},
-    "pancake": {"ru": "блин", "calories": 227, "protein": 6, "fat": 10, "carbs": 28},
-    "waffle": {"ru": "вафля", "calories": 291, "protein": 8, "fat": 14, "carbs": 35},
-}
+class FoodRecord:
+    """Пищевая ценность продукта на 100г"""
+    __slots__ = ("name", "ru", "calories", "protein", "fat", "carbs")
+
+    def __init__(self, name, ru, calories, protein, fat, carbs):
+        self.name = name
+        self.ru = ru
+        self.calories = calories
+        self.protein = protein
+        self.fat = fat
+        self.carbs = carbs
+
+    def __repr__(self):
+        return f"FoodRecord({self.name!r}, {self.ru!r}, {self.calories} ккал)"
+
+def _csv_number(text):
+    text = text.strip() or "0"
+    return float(text) if "." in text else int(text)
+
+def build_food_database(csv_path, db_path):
+    """Собирает SQLite-файл базы продуктов из CSV и атомарно подменяет старый"""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        rows = [
+            (
+                row["name"].strip().lower(), row["ru"].strip(),
+                _csv_number(row["calories"]), _csv_number(row["protein"]),
+                _csv_number(row["fat"]), _csv_number(row["carbs"]),
+                (row.get("aliases") or "").strip()
+            )
+            for row in csv.DictReader(f)
+        ]
+    tmp_path = f"{db_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # NUMERIC: целые значения хранятся как INTEGER, дробные — как REAL
+        conn.execute(
+            "CREATE TABLE foods (name TEXT PRIMARY KEY, ru TEXT NOT NULL, calories NUMERIC, "
+            "protein NUMERIC, fat NUMERIC, carbs NUMERIC, aliases TEXT NOT NULL DEFAULT '')"
+        )
+        conn.executemany("INSERT INTO foods VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+    return len(rows)
+
+class FoodDatabase:
+    """База продуктов в SQLite-файле: индекс названий в памяти, строки читаются по требованию"""
+
+    def __init__(self, db_path=FOOD_DB_PATH, csv_path=FOOD_CSV_PATH, cache_size=FOOD_DB_CACHE_SIZE):
+        self.db_path = db_path
+        self.csv_path = csv_path
+        self.cache_size = cache_size
+        self.index = None
+        self._conn = None
+        self._keys = ()
+        self._mtime = None
+        self._fetch = None
+        self._watcher = None
+        self._swap(self._open())
+
+    def _needs_build(self):
+        if not self.csv_path or not os.path.exists(self.csv_path):
+            return False
+        return not os.path.exists(self.db_path) or os.path.getmtime(self.csv_path) > os.path.getmtime(self.db_path)
+
+    def _open(self):
+        """Открывает файл базы и строит индекс названий (текущее состояние не трогает)"""
+        if self._needs_build():
+            count = build_food_database(self.csv_path, self.db_path)
+            logger.info(f"База продуктов собрана из {self.csv_path}: {count} продуктов")
+        mtime = os.path.getmtime(self.db_path)
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        # Файл отображается в память: воркеры на одной машине делят одну копию страниц в page cache
+        conn.execute(f"PRAGMA mmap_size = {FOOD_DB_MMAP_SIZE}")
+        rows = conn.execute("SELECT name, ru, aliases FROM foods ORDER BY rowid").fetchall()
+        index = FoodIndex(
+            (name, (name, ru, *(alias for alias in aliases.split("|") if alias)))
+            for name, ru, aliases in rows
+        )
+        keys = tuple(name for name, _, _ in rows)
+        return conn, index, keys, mtime
+
+    def _swap(self, state):
+        old_conn = self._conn
+        self._conn, self.index, self._keys, self._mtime = state
+        # Кэш строк привязан к соединению, поэтому пересоздается вместе с ним
+        self._fetch = functools.lru_cache(maxsize=self.cache_size)(self._fetch_row)
+        if old_conn is not None:
+            old_conn.close()
+
+    def _fetch_row(self, key):
+        row = self._conn.execute(
+            "SELECT name, ru, calories, protein, fat, carbs FROM foods WHERE name = ?", (key,)
+        ).fetchone()
+        return FoodRecord(*row) if row else None
+
+    def get(self, key, default=None):
+        record = self._fetch(key)
+        return default if record is None else record
+
+    def __getitem__(self, key):
+        record = self._fetch(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __contains__(self, key):
+        return self._fetch(key) is not None
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _changed(self):
+        try:
+            return self._needs_build() or os.path.getmtime(self.db_path) != self._mtime
+        except FileNotFoundError:
+            return False
+
+    async def reload_if_changed(self):
+        """Перечитывает базу, если файл (или исходный CSV) изменился"""
+        if not self._changed():
+            return False
+        # Сборка и индексация — в отдельном потоке, подмена — атомарно в event loop
+        self._swap(await asyncio.to_thread(self._open))
+        logger.info(f"База продуктов перезагружена: {len(self)} продуктов")
+        return True
+
+    async def _watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload_if_changed()
+            except Exception as e:
+                logger.error(f"Ошибка перезагрузки базы продуктов: {e}")
+
+    def start_watching(self, interval=FOOD_DB_RELOAD_INTERVAL):
+        """Запускает фоновую проверку изменений файла (горячая перезагрузка без рестарта)"""
+        if interval > 0 and self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch(interval), name="food-db-watcher")
+
+    async def stop_watching(self):
+        if self._watcher is not None:
+            watcher, self._watcher = self._watcher, None
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+
+
+food_database = FoodDatabase()
+
+
+# ========== HTTP-КЛИЕНТ WORKFLOW API ==========
+class InferenceClient:
+    """Асинхронный клиент Workflow API с общим пулом keep-alive соединений"""
+
+    def __init__(self, url, max_connections=ROBOFLOW_MAX_CONNECTIONS,
+                 max_keepalive=ROBOFLOW_MAX_KEEPALIVE, keepalive_expiry=ROBOFLOW_KEEPALIVE_EXPIRY,
+                 host_concurrency=ROBOFLOW_HOST_CONCURRENCY, connect_timeout=ROBOFLOW_CONNECT_TIMEOUT,
+                 timeout=ROBOFLOW_TIMEOUT, name="Workflow API"):
+        self.url = url
+        self.name = name
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.host_concurrency = host_concurrency
+        self._client = None
+        # Отдельный лимит одновременных запросов на каждый хост
+        self._host_semaphores = {}
+
+    @property
+    def started(self):
+        return self._client is not None
+
+    async def start(self):
+        """Создает пул соединений (вызывается при старте приложения)"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            logger.info(
+                f"HTTP-клиент {self.name} запущен: {self.limits.max_connections} соединений, "
+                f"{self.host_concurrency} запросов на хост"
+            )
+
+    async def close(self):
+        """Закрывает все соединения пула (вызывается при остановке приложения)"""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+            logger.info(f"HTTP-клиент {self.name} остановлен")
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.host_concurrency)
+        return self._host_semaphores[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url=None):
+        """Место в лимите запросов на хост; ожидание учитывается как этап pool_wait"""
+        semaphore = self._host_semaphore(url or self.url)
+        with stage_timer("pool_wait"):
+            await semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def stream(self, method, url, **kwargs):
+        """Потоковый запрос через пул клиента; лимит на хост — через slot()"""
+        if self._client is None:
+            # Ленивая инициализация, если клиент используется вне Application
+            await self.start()
+        return await self._client.send(self._client.build_request(method, url, **kwargs), stream=True)
+
+
+inference_client = InferenceClient(WORKFLOW_URL)
+# Файлы Telegram при потоковой передаче держат соединение, пока фото выгружается в Workflow API,
+# поэтому у них отдельный пул: скачивания не могут занять соединения, нужные самой выгрузке
+telegram_files = InferenceClient(
+    None, max_connections=TELEGRAM_DOWNLOAD_CONNECTIONS, max_keepalive=TELEGRAM_DOWNLOAD_CONNECTIONS,
+    host_concurrency=TELEGRAM_DOWNLOAD_CONNECTIONS, name="файлов Telegram"
+)
+
+# ========== КЭШ РЕЗУЛЬТАТОВ РАСПОЗНАВАНИЯ ==========
+class InferenceCache:
+    """Кэш результатов по хэшу изображения: LRU в памяти + опциональный уровень на диске"""
+
+    def __init__(self, max_entries=INFERENCE_CACHE_MAX_ENTRIES, max_bytes=INFERENCE_CACHE_MAX_BYTES,
+                 ttl=INFERENCE_CACHE_TTL, directory=INFERENCE_CACHE_DIR, disk_max_bytes=INFERENCE_CACHE_DISK_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory or None
+        self.disk_max_bytes = disk_max_bytes
+        self._pruner = None
+        # content_hash -> (expires_at, size, result)
+        self._entries = OrderedDict()
+        self._size = 0
+        # file_unique_id -> content_hash
+        self._aliases = OrderedDict()
+        self.stats = Counter()
+        if self.directory:
+            os.makedirs(os.path.join(self.directory, "results"), exist_ok=True)
+            os.makedirs(os.path.join(self.directory, "aliases"), exist_ok=True)
+
+    @staticmethod
+    def content_hash(photo_bytes):
+        return hashlib.sha256(photo_bytes).hexdigest()
+
+    # --- память ---
+    def _memory_get(self, content_hash):
+        entry = self._entries.get(content_hash)
+        if entry is None:
+            return None
+        expires_at, size, result = entry
+        if expires_at < time.monotonic():
+            self._memory_drop(content_hash)
+            return None
+        self._entries.move_to_end(content_hash)
+        return result
+
+    def _memory_put(self, content_hash, result, size):
+        if size > self.max_bytes:
+            return
+        if content_hash in self._entries:
+            self._memory_drop(content_hash)
+        self._entries[content_hash] = (time.monotonic() + self.ttl, size, result)
+        self._size += size
+        # Вытесняем самые старые записи по количеству и по суммарному размеру
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            old_hash = next(iter(self._entries))
+            self._memory_drop(old_hash)
+            self.stats["evictions"] += 1
+
+    def _memory_drop(self, content_hash):
+        _, size, _ = self._entries.pop(content_hash)
+        self._size -= size
+
+    def _remember_alias(self, file_unique_id, content_hash):
+        self._aliases[file_unique_id] = content_hash
+        self._aliases.move_to_end(file_unique_id)
+        while len(self._aliases) > self.max_entries * 4:
+            self._aliases.popitem(last=False)
+
+    # --- диск ---
+    def _result_path(self, content_hash):
+        return os.path.join(self.directory, "results", f"{content_hash}.json")
+
+    def _alias_path(self, file_unique_id):
+        name = hashlib.sha256(file_unique_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "aliases", name)
+
+    def _is_fresh(self, path):
+        return time.time() - os.path.getmtime(path) < self.ttl
+
+    def _disk_read(self, path):
+        try:
+            if not self._is_fresh(path):
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _disk_write(self, path, data):
+        # Пишем во временный файл и атомарно подменяем, чтобы не оставлять битых записей
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _disk_prune(self):
+        removed = 0
+        kept = []  # (mtime, size, path) свежих файлов
+        for sub in ("results", "aliases"):
+            folder = os.path.join(self.directory, sub)
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                    if time.time() - stat.st_mtime >= self.ttl:
+                        os.remove(path)
+                        removed += 1
+                    else:
+                        kept.append((stat.st_mtime, stat.st_size, path))
+                except FileNotFoundError:
+                    pass
+        # Сверх лимита удаляем самые давно записанные файлы; привязки к удаленным результатам
+        # становятся обычными промахами
+        total = sum(size for _, size, _ in kept)
+        kept.sort()
+        for _, size, path in kept:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+                self.stats["disk_evictions"] += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    async def prune(self):
+        """Удаляет устаревшие записи дискового кэша и держит его в пределах disk_max_bytes"""
+        if self.directory:
+            removed = await asyncio.to_thread(self._disk_prune)
+            if removed:
+                logger.info(f"Кэш распознавания: удалено {removed} файлов с диска")
+
+    async def _prune_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.prune()
+            except Exception as e:
+                logger.error(f"Ошибка очистки дискового кэша: {e}")
+
+    def start_pruning(self, interval=INFERENCE_CACHE_PRUNE_INTERVAL):
+        """Запускает периодическую очистку дискового кэша (долго работающий процесс иначе заполнит диск)"""
+        if self.directory and interval > 0 and self._pruner is None:
+            self._pruner = asyncio.create_task(self._prune_periodically(interval), name="inference-cache-pruner")
+
+    async def stop_pruning(self):
+        if self._pruner is not None:
+            pruner, self._pruner = self._pruner, None
+            pruner.cancel()
+            await asyncio.gather(pruner, return_exceptions=True)
+
+    # --- публичный интерфейс ---
+    async def get(self, content_hash=None, file_unique_id=None):
+        """Ищет результат по хэшу содержимого или по file_unique_id Telegram.
+
+        Промах по file_unique_id не учитывается: его учтет поиск по хэшу после скачивания
+        (или detect_food_in_stream, если фото идет в API потоком) — одно фото, один промах.
+        """
+        by_alias = content_hash is None
+        if content_hash is None and file_unique_id is not None:
+            content_hash = self._aliases.get(file_unique_id)
+            if content_hash is None and self.directory:
+                data = await asyncio.to_thread(self._disk_read, self._alias_path(file_unique_id))
+                if data:
+                    content_hash = data.decode("ascii")
+                    self._remember_alias(file_unique_id, content_hash)
+        if content_hash is None:
+            return None
+
+        result = self._memory_get(content_hash)
+        if result is not None:
+            self.stats["memory_hits"] += 1
+            return result
+
+        if self.directory:
+            data = await asyncio.to_thread(self._disk_read, self._result_path(content_hash))
+            if data:
+                result = json.loads(data)
+                self._memory_put(content_hash, result, len(data))
+                self.stats["disk_hits"] += 1
+                return result
+
+        if not by_alias:
+            self.stats["misses"] += 1
+        return None
+
+    async def put(self, content_hash, result, file_unique_id=None):
+        """Сохраняет результат распознавания (и привязку file_unique_id к хэшу)"""
+        # Для памяти размер оцениваем без сериализации: основной вес — строка визуализации
+        visualization = result.get("visualization")
+        size = len(json.dumps(result.get("foods", []), ensure_ascii=False))
+        size += len(visualization) if isinstance(visualization, str) else 0
+        self._memory_put(content_hash, result, size)
+        if file_unique_id:
+            self._remember_alias(file_unique_id, content_hash)
+        if self.directory:
+            try:
+                # Сериализация многомегабайтной визуализации тоже уходит в поток
+                data = await asyncio.to_thread(lambda: json.dumps(result, ensure_ascii=False).encode("utf-8"))
+                await asyncio.to_thread(self._disk_write, self._result_path(content_hash), data)
+                if file_unique_id:
+                    await asyncio.to_thread(
+                        self._disk_write, self._alias_path(file_unique_id), content_hash.encode("ascii")
+                    )
+            except OSError as e:
+                logger.error(f"Ошибка записи дискового кэша: {e}")
+
+    async def link(self, content_hash, file_unique_id):
+        """Привязывает новый file_unique_id к уже известному хэшу"""
+        self._remember_alias(file_unique_id, content_hash)
+        if self.directory:
+            try:
+                await asyncio.to_thread(
+                    self._disk_write, self._alias_path(file_unique_id), content_hash.encode("ascii")
+                )
+            except OSError as e:
+                logger.error(f"Ошибка записи дискового кэша: {e}")
+
+    def summary(self):
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        hit_rate = hits / total * 100 if total else 0
+        return (
+            f"попаданий {hits} (память {self.stats['memory_hits']}, диск {self.stats['disk_hits']}), "
+            f"промахов {self.stats['misses']}, вытеснено {self.stats['evictions']}, "
+            f"hit rate {hit_rate:.1f}%, в памяти {len(self._entries)} записей / {self._size // 1024} КБ"
+        )
+
+
+inference_cache = InferenceCache()
+
+# ========== ДНЕВНИК ПИТАНИЯ ==========
+DIARY_TZ = timezone(timedelta(hours=DIARY_UTC_OFFSET))
+NUTRIENTS = ("calories", "protein", "fat", "carbs")
+UNKNOWN_FOOD_CALORIES = 200  # ккал/100г для продукта, которого нет в базе
+
+def meal_nutrition(detected_foods):
+    """Калории и БЖУ приема пищи — по 100г на каждый распознанный объект, как в отчете"""
+    totals = dict.fromkeys(NUTRIENTS, 0.0)
+    for food in detected_foods:
+        food_info = food_database.get(food["name"])
+        if food_info is None:
+            totals["calories"] += UNKNOWN_FOOD_CALORIES
+            continue
+        for nutrient in NUTRIENTS:
+            totals[nutrient] += getattr(food_info, nutrient) or 0
+    return totals
+
+def diary_day(timestamp):
+    """Номер дня (date.toordinal) в часовом поясе дневника"""
+    return datetime.fromtimestamp(timestamp, DIARY_TZ).date().toordinal()
+
+def diary_week(day):
+    # День 1 (1 января 1 года) — понедельник, поэтому недели начинаются с понедельника
+    return (day - 1) // 7
+
+def _totals_upsert(table, key):
+    return (
+        f"INSERT INTO {table} (user_id, {key}, meals, calories, protein, fat, carbs) VALUES (?, ?, ?, ?, ?, ?, ?) "
+        f"ON CONFLICT (user_id, {key}) DO UPDATE SET meals = meals + excluded.meals, "
+        + ", ".join(f"{n} = {n} + excluded.{n}" for n in NUTRIENTS)
+    )
+
+class MealDiary:
+    """Дневник питания в SQLite (WAL): обработчики только ставят запись в очередь,
+    одна фоновая задача пишет пачками и сразу прибавляет прием к итогам дня и недели"""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS meals (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+        "eaten_at REAL NOT NULL, day INTEGER NOT NULL, foods TEXT NOT NULL, calories REAL NOT NULL, "
+        "protein REAL NOT NULL, fat REAL NOT NULL, carbs REAL NOT NULL, photo_key TEXT)",
+        "CREATE INDEX IF NOT EXISTS meals_user_day ON meals (user_id, day)",
+        # Итоги обновляются при записи: /today и /week читают строки по ключу, а не всю историю
+        "CREATE TABLE IF NOT EXISTS daily_totals (user_id INTEGER NOT NULL, day INTEGER NOT NULL, "
+        "meals INTEGER NOT NULL, calories REAL NOT NULL, protein REAL NOT NULL, fat REAL NOT NULL, "
+        "carbs REAL NOT NULL, PRIMARY KEY (user_id, day)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS weekly_totals (user_id INTEGER NOT NULL, week INTEGER NOT NULL, "
+        "meals INTEGER NOT NULL, calories REAL NOT NULL, protein REAL NOT NULL, fat REAL NOT NULL, "
+        "carbs REAL NOT NULL, PRIMARY KEY (user_id, week)) WITHOUT ROWID",
+    )
+    DAILY_UPSERT = _totals_upsert("daily_totals", "day")
+    WEEKLY_UPSERT = _totals_upsert("weekly_totals", "week")
+    PHOTO_KEYS_MAX = 10000  # недавно записанные фото в памяти (остальные проверяются по базе)
+
+    def __init__(self, path=DIARY_DB_PATH, batch_size=DIARY_BATCH_SIZE,
+                 flush_interval=DIARY_FLUSH_INTERVAL, queue_max=DIARY_QUEUE_MAX):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_max = queue_max
+        self.stats = Counter()
+        self._queue = None
+        self._wakeup = None
+        self._writer = None
+        self._conn = None
+        self._reader = None
+        # (user_id, day, photo_key) фото, поставленных в очередь этим процессом
+        self._photo_keys = OrderedDict()
+
+    @property
+    def enabled(self):
+        return self._writer is not None
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # В WAL при сбое питания теряется только последняя транзакция, а fsync на каждый коммит не нужен
+        conn.execute("PRAGMA synchronous = NORMAL")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(meals)")}
+        if "photo_key" not in columns:
+            conn.execute("ALTER TABLE meals ADD COLUMN photo_key TEXT")
+        # Повторно присланное (пересланное) фото — тот же прием пищи: одна запись на пользователя и день
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS meals_photo ON meals (user_id, day, photo_key)")
+        conn.commit()
+        # Читатели в WAL не ждут писателя: отдельное соединение только для чтения
+        reader = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        return conn, reader
+
+    async def start(self):
+        if not self.path or self._writer is not None:
+            return
+        try:
+            self._conn, self._reader = await asyncio.to_thread(self._connect)
+        except sqlite3.Error as e:
+            logger.error(f"Дневник питания отключен: не удалось открыть {self.path}: {e}")
+            return
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._run(), name="meal-diary-writer")
+        logger.info(f"Дневник питания: {self.path}")
+
+    async def stop(self):
+        if self._writer is None:
+            return
+        # Дописываем то, что уже в очереди, и только потом останавливаем писателя
+        try:
+            await asyncio.wait_for(self.flush(), timeout=10)
+        except asyncio.TimeoutError:
+            logger.warning(f"Дневник питания: не записано {self.depth} записей при остановке")
+        writer, self._writer = self._writer, None
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        await asyncio.to_thread(self._close)
+
+    def _close(self):
+        for conn in (self._reader, self._conn):
+            if conn is not None:
+                conn.close()
+        self._conn = self._reader = None
+
+    def _remember_photo(self, key):
+        self._photo_keys[key] = None
+        self._photo_keys.move_to_end(key)
+        while len(self._photo_keys) > self.PHOTO_KEYS_MAX:
+            self._photo_keys.popitem(last=False)
+
+    def _has_photo(self, user_id, day, photo_key):
+        row = self._reader.execute(
+            "SELECT 1 FROM meals WHERE user_id = ? AND day = ? AND photo_key = ?", (user_id, day, photo_key)
+        ).fetchone()
+        return row is not None
+
+    async def contains(self, user_id, eaten_at, photo_key):
+        """Записано ли уже это фото у пользователя за этот день (в очереди или в базе)"""
+        if self._writer is None or photo_key is None:
+            return False
+        key = (user_id, diary_day(eaten_at), photo_key)
+        if key in self._photo_keys:
+            return True
+        try:
+            # Чтение по уникальному индексу — ответ почти не ждет
+            found = await asyncio.to_thread(self._has_photo, *key)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения дневника: {e}")
+            return False
+        if found:
+            self._remember_photo(key)
+        return found
+
+    def record(self, user_id, eaten_at, detected_foods, photo_key=None):
+        """Ставит прием пищи в очередь на запись; не ждет диска. False — дневник выключен или переполнен
+        (или это фото уже поставлено в очередь). photo_key (file_unique_id фото) — то же фото
+        в тот же день второй раз не учитывается; проверить заранее можно через contains()"""
+        if self._writer is None:
+            return False
+        day = diary_day(eaten_at)
+        if photo_key is not None and (user_id, day, photo_key) in self._photo_keys:
+            self.stats["duplicates"] += 1
+            return False
+        if self._queue.qsize() >= self.queue_max:
+            self.stats["dropped"] += 1
+            logger.warning(f"Очередь дневника переполнена, запись пользователя {user_id} отброшена")
+            return False
+        nutrition = meal_nutrition(detected_foods)
+        foods = json.dumps(Counter(food["name"] for food in detected_foods), ensure_ascii=False)
+        self._queue.put_nowait(
+            (user_id, eaten_at, day, photo_key, foods, *(nutrition[n] for n in NUTRIENTS))
+        )
+        if photo_key is not None:
+            self._remember_photo((user_id, day, photo_key))
+        self.stats["recorded"] += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def flush(self):
+        """Барьер: ждет, пока все поставленные до вызова записи будут зафиксированы"""
+        if self._writer is None:
+            return
+        marker = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(marker)
+        self._wakeup.set()
+        await marker
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Копим пачку: до batch_size записей, flush_interval или явного flush
+            if not self._wakeup.is_set():
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            if self._queue.empty():
+                self._wakeup.clear()
+            
+            meals = [item for item in batch if not isinstance(item, asyncio.Future)]
+            if meals:
+                try:
+                    written = await asyncio.to_thread(self._write, meals)
+                    self.stats["written"] += written
+                    self.stats["duplicates"] += len(meals) - written
+                    self.stats["batches"] += 1
+                except sqlite3.Error as e:
+                    self.stats["errors"] += 1
+                    logger.error(f"Ошибка записи дневника ({len(meals)} записей потеряно): {e}")
+            for item in batch:
+                if isinstance(item, asyncio.Future) and not item.done():
+                    item.set_result(None)
+
+    def _write(self, meals):
+        """Пишет пачку одной транзакцией; возвращает число новых записей (повторы фото пропускаются)"""
+        daily, weekly = {}, {}
+        written = 0
+        with self._conn:
+            for meal in meals:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO meals (user_id, eaten_at, day, photo_key, foods, calories, protein, fat, carbs) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", meal
+                )
+                if not cursor.rowcount:
+                    continue  # это фото уже в дневнике за этот день
+                written += 1
+                # Итоги внутри пачки сначала суммируем — по одному upsert на день и неделю
+                user_id, _, day, _, _, *values = meal
+                for totals, key in ((daily, (user_id, day)), (weekly, (user_id, diary_week(day)))):
+                    row = totals.setdefault(key, [0] + [0.0] * len(NUTRIENTS))
+                    row[0] += 1
+                    for i, value in enumerate(values, 1):
+                        row[i] += value
+            self._conn.executemany(self.DAILY_UPSERT, [(*key, *row) for key, row in daily.items()])
+            self._conn.executemany(self.WEEKLY_UPSERT, [(*key, *row) for key, row in weekly.items()])
+        return written
+
+    def _read_totals(self, table, key, user_id, value):
+        row = self._reader.execute(
+            f"SELECT meals, calories, protein, fat, carbs FROM {table} WHERE user_id = ? AND {key} = ?",
+            (user_id, value)
+        ).fetchone()
+        return dict(zip(("meals", *NUTRIENTS), row)) if row else None
+
+    def _read_week(self, user_id, week):
+        totals = self._read_totals("weekly_totals", "week", user_id, week)
+        # Не больше 7 строк по первичному ключу
+        rows = self._reader.execute(
+            "SELECT day, meals, calories FROM daily_totals WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY day",
+            (user_id, week * 7 + 1, week * 7 + 7)
+        ).fetchall()
+        return totals, rows
+
+    async def day_totals(self, user_id, day):
+        """Итоги дня: приемы пищи, калории и БЖУ (None — записей нет)"""
+        await self.flush()
+        return await asyncio.to_thread(self._read_totals, "daily_totals", "day", user_id, day)
+
+    async def week_totals(self, user_id, week):
+        """Итоги недели и список (день, приемы, калории) по дням с записями"""
+        await self.flush()
+        return await asyncio.to_thread(self._read_week, user_id, week)
+
+
+meal_diary = MealDiary()
+
+# ========== ПОДГОТОВКА ИЗОБРАЖЕНИЯ ==========
+def select_photo_size(photo_sizes, min_side=None):
+    """Выбирает самый маленький PhotoSize, которого хватает для входа детектора"""
+    min_side = DETECTOR_INPUT_SIZE if min_side is None else min_side
+    suitable = [p for p in photo_sizes if max(p.width, p.height) >= min_side]
+    if suitable:
+        return min(suitable, key=lambda p: p.width * p.height)
+    # Все версии меньше входа модели — берем самую большую
+    return max(photo_sizes, key=lambda p: p.width * p.height)
+
+def _shrink_image(photo_bytes, max_side, quality):
+    with Image.open(BytesIO(photo_bytes)) as img:
+        if max(img.size) <= max_side:
+            return photo_bytes
+        # Для JPEG декодируем сразу в уменьшенном масштабе (DCT scaling) — заметно быстрее
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=quality)
+        return out.getvalue()
+
+async def prepare_image(photo_bytes, max_side=None, quality=None):
+    """Уменьшает изображение до IMAGE_MAX_SIDE и перекодирует в JPEG (в отдельном потоке)"""
+    max_side = IMAGE_MAX_SIDE if max_side is None else max_side
+    quality = IMAGE_JPEG_QUALITY if quality is None else quality
+    try:
+        return await asyncio.to_thread(_shrink_image, photo_bytes, max_side, quality)
+    except Exception as e:
+        # Не смогли разобрать картинку — отправляем как есть, пусть решает детектор
+        logger.error(f"Ошибка подготовки изображения: {e}")
+        return photo_bytes
+
+# ========== ОЧЕРЕДЬ РАСПОЗНАВАНИЯ ==========
+class QueueFullError(Exception):
+    """Очередь распознавания переполнена"""
+
+class StaleJobError(Exception):
+    """Задача отменена, потому что пользователь прислал более новое фото"""
+
+class InferenceJob:
+    """Задача в очереди распознавания"""
+    __slots__ = ("chat_id", "message_id", "factory", "future", "context", "task", "queued_at")
+
+    def __init__(self, chat_id, factory, future, message_id=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.factory = factory
+        self.future = future
+        self.queued_at = time.perf_counter()
+        # Задача выполняется в контексте отправителя (логирование, счетчики запросов)
+        self.context = contextvars.copy_context()
+        self.task = None
+
+class InferenceScheduler:
+    """Очередь перед детектором: общий лимит параллельности, round-robin между чатами, backpressure"""
+
+    def __init__(self, concurrency=INFERENCE_CONCURRENCY, max_queue=INFERENCE_QUEUE_MAX,
+                 cancel_stale=INFERENCE_CANCEL_STALE):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.cancel_stale = cancel_stale
+        # chat_id -> очередь задач; порядок ключей — порядок обхода round-robin
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._running = {}  # chat_id -> set(InferenceJob)
+        self._available = None
+        self._workers = []
+        self.stats = Counter()
+
+    @property
+    def depth(self):
+        return self._queued
+
+    @property
+    def busy(self):
+        return sum(len(jobs) for jobs in self._running.values())
+
+    async def start(self):
+        """Запускает воркеры (вызывается при старте приложения)"""
+        if self._workers:
+            return
+        self._available = asyncio.Semaphore(0)
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"inference-worker-{i}")
+            for i in range(self.concurrency)
+        ]
+        logger.info(f"Очередь распознавания: {self.concurrency} воркеров, до {self.max_queue} задач")
+
+    async def stop(self):
+        """Останавливает воркеры и отменяет все незавершенные задачи"""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for queue in self._queues.values():
+            for job in queue:
+                if not job.future.done():
+                    job.future.cancel()
+        self._queues.clear()
+        self._queued = 0
+
+    def _position(self, chat_id, index):
+        """Сколько задач будет взято раньше задачи index в очереди чата (round-robin)"""
+        ahead = 0
+        before = True
+        for other_id, queue in self._queues.items():
+            if other_id == chat_id:
+                before = False
+                ahead += index
+            else:
+                ahead += min(len(queue), index + 1 if before else index)
+        return ahead
+
+    @staticmethod
+    def _older(job, message_id):
+        # Без message_id (или у задачи его нет) новее считается последняя поставленная задача
+        return message_id is None or job.message_id is None or job.message_id < message_id
+
+    def _has_newer(self, chat_id, message_id):
+        """Есть ли у чата задача по более новому сообщению (апдейты обрабатываются параллельно
+        и могут дойти до очереди не в том порядке, в каком пришли)"""
+        if message_id is None:
+            return False
+        jobs = [*self._queues.get(chat_id, ()), *self._running.get(chat_id, ())]
+        return any(job.message_id is not None and job.message_id > message_id for job in jobs)
+
+    def _cancel_chat(self, chat_id, message_id=None):
+        cancelled = 0
+        queue = self._queues.get(chat_id)
+        if queue:
+            stale = [job for job in queue if self._older(job, message_id)]
+            for job in stale:
+                queue.remove(job)
+                if not job.future.done():
+                    job.future.set_exception(StaleJobError())
+                cancelled += 1
+            self._queued -= len(stale)
+            if not queue:
+                del self._queues[chat_id]
+        for job in self._running.get(chat_id, ()):
+            if self._older(job, message_id) and job.task is not None and not job.task.done():
+                job.task.cancel()
+                cancelled += 1
+        self.stats["stale_cancelled"] += cancelled
+
+    def submit(self, chat_id, factory, message_id=None):
+        """Ставит задачу в очередь; возвращает (future, позиция в очереди или 0).
+        С cancel_stale задачи чата по более старым сообщениям (меньший message_id) отменяются"""
+        if not self._workers:
+            raise RuntimeError("InferenceScheduler не запущен")
+        future = asyncio.get_running_loop().create_future()
+        if self.cancel_stale:
+            if self._has_newer(chat_id, message_id):
+                # Более новое фото уже в работе — это сразу устарело
+                self.stats["stale_cancelled"] += 1
+                future.set_exception(StaleJobError())
+                return future, 0
+            self._cancel_chat(chat_id, message_id)
+        if self._queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise QueueFullError()
+
+        job = InferenceJob(chat_id, factory, future, message_id)
+        queue = self._queues.setdefault(chat_id, deque())
+        queue.append(job)
+        self._queued += 1
+        self.stats["submitted"] += 1
+
+        # Позиция с учетом свободных воркеров: 0 — задача начнется сразу
+        idle = max(0, self.concurrency - self.busy)
+        position = max(0, self._position(chat_id, len(queue) - 1) + 1 - idle)
+        self._available.release()
+        return job.future, position
+
+    def _next_job(self):
+        while self._queues:
+            chat_id, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            self._queued -= 1
+            if queue:
+                # Чат уходит в конец круга, чтобы не занимать воркеры подряд
+                self._queues.move_to_end(chat_id)
+            else:
+                del self._queues[chat_id]
+            if not job.future.done():
+                return job
+        return None
+
+    async def _worker(self):
+        while True:
+            await self._available.acquire()
+            job = self._next_job()
+            if job is None:
+                continue
+            running = self._running.setdefault(job.chat_id, set())
+            running.add(job)
+            try:
+                # Ожидание в очереди учитываем в статистике апдейта, которому принадлежит задача
+                job.context.run(record_stage, "queue_wait", time.perf_counter() - job.queued_at)
+                job.task = job.context.run(asyncio.create_task, job.factory())
+                await asyncio.wait([job.task])
+                if job.future.done():
+                    continue
+                if job.task.cancelled():
+                    job.future.set_exception(StaleJobError())
+                elif job.task.exception() is not None:
+                    job.future.set_exception(job.task.exception())
+                else:
+                    job.future.set_result(job.task.result())
+                self.stats["completed"] += 1
+            except asyncio.CancelledError:
+                if job.task is not None:
+                    job.task.cancel()
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            finally:
+                running.discard(job)
+                if not running:
+                    self._running.pop(job.chat_id, None)
+
+
+inference_scheduler = InferenceScheduler()
+
+# ========== АЛЬБОМЫ (MEDIA GROUP) ==========
+class MediaGroupCollector:
+    """Собирает фото одного альбома (media_group_id) в одну пачку"""
+
+    def __init__(self, window=MEDIA_GROUP_WINDOW, max_wait=MEDIA_GROUP_MAX_WAIT):
+        self.window = window
+        self.max_wait = max_wait
+        # (chat_id, media_group_id) -> {"messages", "started", "updated"}
+        self._groups = {}
+
+    def add(self, message, on_complete, create_task):
+        """Добавляет фото в альбом; первое фото запускает таймер сборки"""
+        key = (message.chat_id, message.media_group_id)
+        now = time.monotonic()
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = {"messages": [], "started": now, "updated": now}
+            create_task(self._flush(key, on_complete))
+        group["messages"].append(message)
+        group["updated"] = now
+
+    async def _flush(self, key, on_complete):
+        group = self._groups[key]
+        # Ждем, пока фото альбома перестанут приходить, но не дольше max_wait
+        while True:
+            deadline = min(group["updated"] + self.window, group["started"] + self.max_wait)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        del self._groups[key]
+        messages = sorted(group["messages"], key=lambda m: m.message_id)
+        await on_complete(messages)
+
+
+media_groups = MediaGroupCollector()
+
+# ========== ЛОКАЛЬНАЯ ОТРИСОВКА РАЗМЕТКИ ==========
+# Шрифты с кириллицей (в Docker-образе ставится пакет fonts-dejavu-core)
+FONT_CANDIDATES = (
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans-Bold.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:\\Windows\\Fonts\\arialbd.ttf",
+)
+
+# Контрастная палитра для рамок (цвет закреплен за классом продукта)
+BOX_PALETTE = (
+    (255, 56, 56), (255, 112, 31), (255, 178, 29), (207, 210, 49), (72, 249, 10),
+    (61, 219, 134), (26, 147, 52), (0, 212, 187), (44, 153, 168), (0, 194, 255),
+    (52, 69, 147), (100, 115, 255), (0, 24, 236), (132, 56, 255), (203, 56, 255),
+    (255, 149, 200), (255, 55, 199), (146, 204, 23), (255, 157, 151), (82, 0, 133),
+)
+
+@functools.lru_cache(maxsize=16)
+def load_font(size):
+    """TrueType-шрифт с кириллицей нужного размера (загружается один раз)"""
+    for path in (FONT_PATH, *FONT_CANDIDATES):
+        if path and os.path.exists(path):
+            return ImageFont.truetype(path, size)
+    logger.warning("⚠️ Шрифт с кириллицей не найден — задайте FONT_PATH")
+    return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=1024)
+def box_colors(name):
+    """Цвет рамки и контрастный цвет текста для класса продукта"""
+    color = BOX_PALETTE[zlib.crc32(name.encode("utf-8")) % len(BOX_PALETTE)]
+    luminance = 0.299 * color[0] + 0.587 * color[1] + 0.114 * color[2]
+    return color, (0, 0, 0) if luminance > 150 else (255, 255, 255)
+
+def draw_boxes(photo_bytes, boxes, quality=IMAGE_JPEG_QUALITY):
+    """Рисует рамки с подписями на фото и возвращает JPEG"""
+    with Image.open(BytesIO(photo_bytes)) as source:
+        img = ImageOps.exif_transpose(source).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    line_width = max(2, round(max(img.size) / 300))
+    font = load_font(max(12, round(max(img.size) / 40)))
+    pad = line_width
+    
+    for box in boxes:
+        x0 = box["x"] - box["width"] / 2
+        y0 = box["y"] - box["height"] / 2
+        x1 = box["x"] + box["width"] / 2
+        y1 = box["y"] + box["height"] / 2
+        color, text_color = box_colors(box["name"])
+        draw.rectangle((x0, y0, x1, y1), outline=color, width=line_width)
+        
+        # Подпись над рамкой, а если не помещается — внутри у верхнего края
+        left, top, right, bottom = draw.textbbox((0, 0), box["label"], font=font)
+        label_height = bottom - top + 2 * pad
+        label_y = y0 - label_height if y0 - label_height >= 0 else y0
+        draw.rectangle((x0, label_y, x0 + right - left + 2 * pad, label_y + label_height), fill=color)
+        draw.text((x0 + pad - left, label_y + pad - top), box["label"], fill=text_color, font=font)
+    
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+class BoxRenderer:
+    """Локальная отрисовка разметки в пуле потоков (Pillow отпускает GIL при декодировании и сжатии)"""
+
+    def __init__(self, workers=RENDER_WORKERS):
+        self.workers = workers
+        self._executor = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+
+    def stop(self):
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def render(self, photo_bytes, boxes):
+        """JPEG с рамками и подписями "название · ккал/100г" для рамок из результата распознавания"""
+        self.start()
+        labeled = []
+        for box in boxes:
+            food_info = food_database.get(box["name"])
+            if food_info:
+                label = f"{food_info.ru.capitalize()} · {food_info.calories} ккал"
+            else:
+                label = box["name"]
+            labeled.append(dict(box, label=label))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, draw_boxes, photo_bytes, labeled)
+
+
+box_renderer = BoxRenderer()
+
+# ========== ФУНКЦИЯ РАСПОЗНАВАНИЯ ЕДЫ ==========
+def _request_envelope(with_visualization):
+    """Начало и конец JSON-тела запроса к Workflow API — между ними идет base64 фото"""
+    suffix = b'"}'
+    if not with_visualization:
+        # Просим только предсказания: без многомегабайтной картинки в ответе
+        suffix += b',"excluded_fields":["visualization"]'
+    return b'{"image":{"type":"base64","value":"', suffix + b'}'
+
+async def _iter_chunks(photo_bytes, chunk_size=STREAM_CHUNK_SIZE):
+    view = memoryview(photo_bytes)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+def _bytes_opener(photo_bytes):
+    async def open_chunks():
+        return _iter_chunks(photo_bytes)
+    return open_chunks
+
+async def _base64_body(chunks, prefix, suffix):
+    """Тело запроса по кускам: base64 кодируется на лету, целиком фото в памяти не собирается"""
+    yield prefix
+    tail = b""
+    async for chunk in chunks:
+        data = tail + chunk if tail else chunk
+        cut = len(data) - len(data) % 3
+        tail = bytes(data[cut:])
+        if cut:
+            yield binascii.b2a_base64(data[:cut], newline=False)
+    if tail:
+        yield binascii.b2a_base64(tail, newline=False)
+    yield suffix
+
+async def _timed(parts, timing, key):
+    """Пропускает куски насквозь и копит в timing[key] время ожидания следующего куска"""
+    resumed = time.perf_counter()
+    async for part in parts:
+        timing[key] += time.perf_counter() - resumed
+        yield part
+        resumed = time.perf_counter()
+    timing[key] += time.perf_counter() - resumed
+
+async def request_detection(open_chunks, size, with_visualization):
+    """Отправляет фото (поток кусков байтов) в Workflow API и разбирает предсказания.
+
+    open_chunks — async-функция, которая открывает источник и возвращает поток кусков.
+    Она вызывается, когда слот хоста уже получен, но до отправки запроса: ошибка источника
+    (например, 5xx от Telegram) не обрывает выгрузку на середине тела.
+
+    Этапы: pool_wait — ожидание слота хоста, upload — отправка тела (без времени ожидания
+    кусков фото: для потока это скачивание из Telegram, оно учитывается как download),
+    server — от конца отправки до заголовков ответа, response — чтение тела ответа.
+    """
+    params = {
+        "access_key": ROBOFLOW_API_KEY,
+        "workspace": WORKSPACE_NAME
+    }
+    prefix, suffix = _request_envelope(with_visualization)
+    headers = {"Content-Type": "application/json"}
+    if size is not None:
+        # Размер base64 известен заранее — обходимся без chunked-кодирования
+        headers["Content-Length"] = str(len(prefix) + 4 * math.ceil(size / 3) + len(suffix))
+    
+    timing = {"source": 0.0, "sent": None}
+    
+    async def body():
+        async for part in _base64_body(_timed(chunks, timing, "source"), prefix, suffix):
+            yield part
+        timing["sent"] = time.perf_counter()
+    
+    # Отправляем запрос через общий пул keep-alive соединений
+    async with inference_client.slot():
+        chunks = await open_chunks()
+        started = time.perf_counter()
+        try:
+            response = await inference_client.stream("POST", inference_client.url, params=params,
+                                                     headers=headers, content=body())
+        except Exception:
+            STAGE_ERRORS.labels("upload").inc()
+            raise
+        try:
+            headers_at = time.perf_counter()
+            # Сервер может ответить (ошибкой), не дочитав тело
+            sent = timing["sent"] or headers_at
+            record_stage("upload", max(0.0, sent - started - timing["source"]))
+            record_stage("server", headers_at - sent)
+            with stage_timer("response"):
+                await response.aread()
+        finally:
+            await response.aclose()
+    
+    if response.status_code != 200:
+        raise UpstreamError(response.status_code, response.text)
+    
+    with stage_timer("parse"):
+        return _parse_response(response)
+
+def _parse_response(response):
+    result = response.json()
+    
+    # Workflow возвращает список результатов, берем первый
+    if isinstance(result, list) and len(result) > 0:
+        result_data = result[0]
+    else:
+        result_data = result
+    
+    # Извлекаем предсказания
+    predictions = result_data.get('predictions', [])
+    visualization = result_data.get('visualization', None)
+    return parse_detection(predictions, visualization)
+
+def parse_detection(predictions, visualization=None):
+    """Результат распознавания из предсказаний в формате Roboflow (общий для всех детекторов)"""
+    # Обрабатываем предсказания
+    detected_foods = []
+    boxes = []
+    if predictions:
+        for pred in predictions:
+            food_name = pred.get('class', '').lower()
+            confidence = pred.get('confidence', 0) * 100  # в процентах
+            
+            # Фильтруем только продукты с достаточной уверенностью
+            if confidence > 40:  # Порог 40%
+                food_info = food_database.get(food_name)
+                detected_foods.append({
+                    "name": food_name,
+                    "confidence": round(confidence, 1),
+                    "russian_name": food_info.ru if food_info else food_name,
+                    "raw_prediction": pred
+                })
+                PREDICTIONS.labels("kept").inc()
+                # Все рамки (а не только лучшая на продукт) — для локальной отрисовки
+                if all(k in pred for k in ("x", "y", "width", "height")):
+                    boxes.append({
+                        "name": food_name,
+                        "confidence": round(confidence, 1),
+                        "x": pred["x"], "y": pred["y"],
+                        "width": pred["width"], "height": pred["height"]
+                    })
+    
+            else:
+                PREDICTIONS.labels("filtered").inc()
+    
+    # Убираем дубликаты (берем продукт с наибольшей уверенностью)
+    unique_foods = {}
+    for food in detected_foods:
+        name = food["name"]
+        if name not in unique_foods or food["confidence"] > unique_foods[name]["confidence"]:
+            unique_foods[name] = food
+    
+    # Возвращаем результат с визуализацией
+    return {
+        "foods": list(unique_foods.values())[:5],  # Возвращаем топ-5
+        "boxes": boxes[:MAX_RENDER_BOXES],
+        "visualization": visualization  # base64 изображение с разметкой
+    }
+
+# ========== УСТОЙЧИВОСТЬ ВЫЗОВОВ ДЕТЕКТОРА ==========
+class UpstreamError(Exception):
+    """Workflow API ответил ошибкой"""
+
+    def __init__(self, status_code, text=""):
+        super().__init__(f"Workflow API ошибка: {status_code}, {text[:200]}")
+        self.status_code = status_code
+        # 429 и 5xx — временные, 4xx — ошибка запроса, повтор не поможет
+        self.retryable = status_code == 429 or status_code >= 500
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут: детектор временно не вызываем"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name}: предохранитель разомкнут, повтор через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+class DownloadError(Exception):
+    """Не удалось скачать файл из Telegram при потоковой передаче — это не сбой Workflow API"""
+
+    def __init__(self, error):
+        super().__init__(f"скачивание из Telegram: {error!r}")
+        status_code = error.response.status_code if isinstance(error, httpx.HTTPStatusError) else None
+        self.retryable = (
+            status_code == 429 or (status_code or 0) >= 500
+            or isinstance(error, httpx.TransportError)
+        )
+
+def is_retryable(error):
+    """Временная ли ошибка (сеть, таймаут, 429/5xx)"""
+    if isinstance(error, (UpstreamError, DownloadError)):
+        return error.retryable
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+class CircuitBreaker:
+    """Предохранитель: после серии неудач запросы сразу отклоняются, через паузу — один пробный"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.stats = Counter()
+        self._opened_at = 0.0
+        self._probe = False
+
+    def retry_after(self):
+        """Сколько секунд до следующего пробного запроса (0 — запросы пропускаются)"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self):
+        """Вызывается перед запросом; при разомкнутом предохранителе — CircuitOpenError"""
+        if self.state == self.OPEN:
+            wait = self.retry_after()
+            if wait > 0:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.name, wait)
+            self.state = self.HALF_OPEN
+            self._probe = False
+        if self.state == self.HALF_OPEN:
+            # Пока идет пробный запрос, остальные не пускаем
+            if self._probe:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.name, 1.0)
+            self._probe = True
+
+    def record_success(self):
+        self.failures = 0
+        self._probe = False
+        if self.state != self.CLOSED:
+            logger.info(f"✅ Предохранитель {self.name} замкнут — сервис снова отвечает")
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats["opened"] += 1
+                logger.warning(
+                    f"⚠️ Предохранитель {self.name} разомкнут после {self.failures} неудач "
+                    f"на {self.reset_timeout:.0f} с"
+                )
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def release(self):
+        """Запрос отменен без результата — освобождаем место пробного запроса"""
+        self._probe = False
+
+class RetryBudget:
+    """Бюджет повторов: не больше ratio от числа запросов за окно, чтобы не добивать упавший сервис"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_retries=RETRY_BUDGET_MIN, window=RETRY_BUDGET_WINDOW):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+
+    def _trim(self, now):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append(now)
+
+    def try_spend(self):
+        """Списывает один повтор, если бюджет позволяет"""
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._retries) >= max(self.min_retries, self.ratio * len(self._requests)):
+            return False
+        self._retries.append(now)
+        return True
+
+class LatencyTracker:
+    """Скользящая выборка задержек успешных запросов для порога hedging"""
+
+    def __init__(self, size=500):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
 
-# ========== ФУНКЦИЯ РАСПОЗНАВАНИЯ ЕДЫ ==========
-async def detect_food_in_photo(photo_bytes):
-    """Распознает еду на фото через Roboflow Workflow API"""
+    def quantile(self, q, min_samples=HEDGE_MIN_SAMPLES):
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# ========== ДЕТЕКТОРЫ ==========
+class RemoteDetector:
+    """Roboflow Workflow API: повторы с бюджетом, предохранитель и hedging; умеет принимать фото потоком"""
+
+    name = "remote"
+    streams = True
+    available = True
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(self.name)
+        self.retry_budget = RetryBudget()
+        self.latency = LatencyTracker()
+        self.stats = Counter()
+
+    async def start(self):
+        pass  # пулом соединений управляет inference_client
+
+    async def stop(self):
+        pass
+
+    async def detect(self, photo_bytes, with_visualization):
+        return await self._call(
+            lambda: request_detection(_bytes_opener(photo_bytes), len(photo_bytes), with_visualization),
+            replayable=True
+        )
+
+    async def detect_stream(self, source, with_visualization):
+        # Каждая попытка и каждый дубль заново скачивают файл из Telegram — поток тоже можно повторить
+        return await self._call(
+            lambda: request_detection(source.open, source.size, with_visualization),
+            replayable=True
+        )
+
+    async def _call(self, make_request, replayable):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + DETECT_DEADLINE
+        self.retry_budget.record_request()
+        self.stats["requests"] += 1
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = await self._attempt(make_request, replayable, deadline)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if isinstance(e, DownloadError):
+                    # Сбой на стороне Telegram: Workflow API тут ни при чем, предохранитель не трогаем
+                    self.breaker.release()
+                    self.stats["download_errors"] += 1
+                    if not e.retryable:
+                        raise
+                elif not is_retryable(e):
+                    # Сервис ответил — с ним все в порядке, ошибка в запросе
+                    self.breaker.record_success()
+                    raise
+                else:
+                    self.breaker.record_failure()
+                    self.stats["failures"] += 1
+                attempt += 1
+                delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+                if not replayable or attempt >= RETRY_ATTEMPTS or loop.time() + delay >= deadline:
+                    raise
+                if not self.retry_budget.try_spend():
+                    self.stats["retry_budget_exhausted"] += 1
+                    raise
+                self.stats["retries"] += 1
+                origin = "Telegram" if isinstance(e, DownloadError) else "Workflow API"
+                logger.warning(f"{origin}: {e!r}, повтор {attempt} через {delay:.2f} с")
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def _attempt(self, make_request, replayable, deadline):
+        loop = asyncio.get_running_loop()
+        timeout = max(0.0, deadline - loop.time())
+        hedge_after = self.latency.quantile(HEDGE_QUANTILE) if HEDGE_REQUESTS and replayable else None
+        if hedge_after is not None and hedge_after < timeout:
+            return await self._hedged(make_request, hedge_after, deadline)
+        started = loop.time()
+        result = await asyncio.wait_for(make_request(), timeout)
+        self.latency.add(loop.time() - started)
+        return result
+
+    async def _hedged(self, make_request, hedge_after, deadline):
+        """Если ответа нет дольше p95, параллельно отправляем дубль и берем первый успешный ответ"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        primary = asyncio.ensure_future(make_request())
+        pending = {primary}
+        error = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            # Дубль — тоже дополнительная нагрузка на сервис, поэтому из бюджета повторов
+            if not done and self.retry_budget.try_spend():
+                self.stats["hedges"] += 1
+                pending.add(asyncio.ensure_future(make_request()))
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        self.latency.add(loop.time() - started)
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+        finally:
+            for task in pending:
+                task.cancel()
+
+def load_detector_labels(model_path, labels_path=ONNX_LABELS_PATH):
+    """Имена классов локальной модели (для dummy — продукты из базы)"""
+    if model_path == "dummy" and not labels_path:
+        return sorted(food_database)
+    labels_path = labels_path or os.path.splitext(model_path)[0] + ".txt"
+    with open(labels_path, encoding="utf-8") as f:
+        return [line.strip().lower() for line in f if line.strip()]
+
+class OnnxModel:
+    """YOLOv8-совместимая ONNX-модель: вход [N, 3, S, S] RGB 0..1, выход [N, 4 + классы, якоря]"""
+
+    def __init__(self, path, labels, threads=1):
+        if ort is None:
+            raise RuntimeError("Для локального детектора установите onnxruntime")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch, _, height, _ = model_input.shape
+        self.input_size = height if isinstance(height, int) else DETECTOR_INPUT_SIZE
+        # Модель с фиксированным батчем 1 прогоняем по одному фото
+        self.single = batch == 1
+        self.labels = labels
+
+    def run(self, batch):
+        if self.single:
+            return np.concatenate([self.session.run(None, {self.input_name: item[None]})[0] for item in batch])
+        return self.session.run(None, {self.input_name: batch})[0]
+
+class DummyModel:
+    """Крошечная модель для офлайн-тестов: одна рамка в центре, класс по средней яркости фото"""
+
+    input_size = 64
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def run(self, batch):
+        count, classes = len(batch), len(self.labels)
+        output = np.zeros((count, 4 + classes, 1), dtype=np.float32)
+        half = self.input_size / 2
+        output[:, :4, 0] = (half, half, half, half)
+        brightness = batch.mean(axis=(1, 2, 3))
+        class_ids = np.minimum((brightness * classes).astype(int), classes - 1)
+        output[np.arange(count), 4 + class_ids, 0] = 0.9
+        return output
+
+def load_detector_model(path, labels, threads=1):
+    if path == "dummy":
+        return DummyModel(labels)
+    return OnnxModel(path, labels, threads)
+
+def _letterbox(photo_bytes, size):
+    """Вписывает фото в квадрат size x size с полями; возвращает тензор и параметры обратного пересчета"""
+    with Image.open(BytesIO(photo_bytes)) as source:
+        img = ImageOps.exif_transpose(source).convert("RGB")
+    scale = min(size / img.width, size / img.height)
+    resized = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BILINEAR)
+    pad_x, pad_y = (size - resized.width) // 2, (size - resized.height) // 2
+    canvas = Image.new("RGB", (size, size), (114, 114, 114))
+    canvas.paste(resized, (pad_x, pad_y))
+    tensor = np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1) / 255.0
+    return tensor, scale, pad_x, pad_y
+
+def _nms(boxes, scores, class_ids, iou_threshold):
+    """Жадный NMS отдельно по каждому классу; возвращает индексы оставленных рамок"""
+    # Сдвиг по классу разводит рамки разных классов, и они не подавляют друг друга
+    offset = class_ids[:, None] * 100000.0
+    corners = np.concatenate([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], axis=1) + offset
+    areas = boxes[:, 2] * boxes[:, 3]
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        top_left = np.maximum(corners[best, :2], corners[rest, :2])
+        bottom_right = np.minimum(corners[best, 2:], corners[rest, 2:])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+        iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+        order = rest[iou < iou_threshold]
+    return keep
+
+def _decode_output(output, scale, pad_x, pad_y, labels):
+    """Предсказания в формате Roboflow (координаты исходного фото) из выхода YOLO для одного фото"""
+    predictions = output.T  # [якоря, 4 + классы]
+    scores = predictions[:, 4:]
+    class_ids = scores.argmax(axis=1)
+    confidences = scores[np.arange(len(predictions)), class_ids]
+    mask = confidences >= LOCAL_CONFIDENCE
+    boxes, class_ids, confidences = predictions[mask, :4], class_ids[mask], confidences[mask]
+    result = []
+    for i in _nms(boxes, confidences, class_ids, LOCAL_IOU):
+        cx, cy, width, height = boxes[i]
+        class_id = int(class_ids[i])
+        result.append({
+            "class": labels[class_id] if class_id < len(labels) else str(class_id),
+            "confidence": float(confidences[i]),
+            "x": float((cx - pad_x) / scale), "y": float((cy - pad_y) / scale),
+            "width": float(width / scale), "height": float(height / scale)
+        })
+    return result
+
+# Модель загружается один раз в каждом процессе пула
+_worker_model = None
+
+def _init_local_worker(model_path, labels, threads):
+    global _worker_model
+    _worker_model = load_detector_model(model_path, labels, threads)
+
+def _run_local_batch(images):
+    """Один проход модели по батчу фото (выполняется в процессе пула)"""
+    prepared = []
+    for photo_bytes in images:
+        try:
+            prepared.append(_letterbox(photo_bytes, _worker_model.input_size))
+        except Exception:
+            prepared.append(None)  # битое фото — None только для него, а не для всего батча
+    valid = [p for p in prepared if p is not None]
+    if not valid:
+        return [None] * len(images)
+    outputs = iter(_worker_model.run(np.stack([p[0] for p in valid])))
+    return [
+        _decode_output(next(outputs), *p[1:], _worker_model.labels) if p is not None else None
+        for p in prepared
+    ]
+
+class LocalDetector:
+    """Локальный детектор на CPU: ONNX-модель в пуле процессов с микробатчингом"""
+
+    name = "local"
+    streams = False
+    breaker = None  # локальная модель не зависит от сети
+
+    def __init__(self, model_path=ONNX_MODEL_PATH, workers=LOCAL_DETECTOR_WORKERS,
+                 batch_size=LOCAL_BATCH_SIZE, batch_wait=LOCAL_BATCH_WAIT):
+        self.model_path = model_path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.batches = Counter()  # размер батча -> сколько раз
+        self._pool = None
+        self._queue = None
+        self._batchers = []
+
+    @property
+    def available(self):
+        return self._pool is not None
+
+    async def start(self):
+        if self._pool is not None:
+            return
+        if np is None:
+            logger.error("❌ Локальный детектор отключен: не установлен numpy")
+            return
+        if not self.model_path:
+            logger.error("❌ Локальный детектор отключен: не задан ONNX_MODEL_PATH")
+            return
+        labels = load_detector_labels(self.model_path)
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        # spawn: форк процесса с работающим event loop и потоками небезопасен
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_local_worker,
+            initargs=(self.model_path, labels, threads)
+        )
+        self._queue = asyncio.Queue()
+        # По сборщику батчей на процесс: пока один батч считается, следующий уже собирается
+        self._batchers = [asyncio.create_task(self._batcher()) for _ in range(self.workers)]
+        logger.info(
+            f"Локальный детектор запущен: {self.model_path}, {self.workers} процессов, "
+            f"батч до {self.batch_size}"
+        )
+
+    async def stop(self):
+        if self._pool is None:
+            return
+        for task in self._batchers:
+            task.cancel()
+        await asyncio.gather(*self._batchers, return_exceptions=True)
+        self._batchers = []
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Локальный детектор остановлен"))
+        pool, self._pool = self._pool, None
+        await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+    async def detect(self, photo_bytes, with_visualization):
+        if self._pool is None:
+            raise RuntimeError("Локальный детектор не запущен")
+        # Картинку с разметкой локальная модель не рисует — только предсказания
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((bytes(photo_bytes), future))
+        with stage_timer("local_inference"):
+            predictions = await future
+        return parse_detection(predictions) if predictions is not None else None
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # Короткое ожидание, чтобы одновременно пришедшие фото ушли одним проходом модели
+            if self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_wait)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            batch = [(photo, future) for photo, future in batch if not future.done()]
+            if not batch:
+                continue
+            self.batches[len(batch)] += 1
+            try:
+                results = await loop.run_in_executor(self._pool, _run_local_batch, [photo for photo, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), predictions in zip(batch, results):
+                if not future.done():
+                    future.set_result(predictions)
+
+DETECTORS = {"remote": RemoteDetector, "local": LocalDetector}
+
+class DetectorRouter:
+    """Детекторы в порядке DETECTOR_BACKENDS: при ошибке или пустом ответе — следующий"""
+
+    def __init__(self, detectors):
+        self.detectors = detectors
+        self.stats = Counter()
+
+    @property
+    def names(self):
+        return [detector.name for detector in self.detectors]
+
+    @property
+    def streamable(self):
+        # Запасному детектору нужно фото целиком, поэтому поток — только без него
+        return len(self.detectors) == 1 and self.detectors[0].streams
+
+    async def start(self):
+        for detector in self.detectors:
+            await detector.start()
+
+    async def stop(self):
+        for detector in self.detectors:
+            await detector.stop()
+
+    def _done(self, detector, detection):
+        if detection is None:
+            self.stats[f"{detector.name}_failed"] += 1
+            return None
+        self.stats[detector.name if detection["foods"] else f"{detector.name}_empty"] += 1
+        detection["detector"] = detector.name
+        return detection
+
+    def retry_after(self):
+        """Через сколько секунд появится рабочий детектор (None — есть уже сейчас)"""
+        waits = []
+        for detector in self.detectors:
+            if not detector.available:
+                continue
+            wait = detector.breaker.retry_after() if detector.breaker else 0.0
+            if wait <= 0:
+                return None
+            waits.append(wait)
+        return min(waits) if waits else None
+
+    def metrics(self):
+        """Состояние предохранителей и счетчики повторов по детекторам"""
+        metrics = {}
+        for detector in self.detectors:
+            entry = dict(getattr(detector, "stats", {}))
+            if detector.breaker:
+                entry["breaker"] = detector.breaker.state
+                entry.update({f"breaker_{k}": v for k, v in detector.breaker.stats.items()})
+            metrics[detector.name] = entry
+        return metrics
+
+    async def detect(self, photo_bytes, with_visualization):
+        circuit_error = None
+        answered = False
+        empty = None
+        for detector in self.detectors:
+            if not detector.available:
+                continue
+            try:
+                detection = await detector.detect(photo_bytes, with_visualization)
+            except CircuitOpenError as e:
+                circuit_error = e
+                continue
+            except Exception as e:
+                logger.error(f"Детектор {detector.name}: {e}")
+                detection = None
+            answered = True
+            if self._done(detector, detection) is None:
+                continue
+            if detection["foods"]:
+                return detection
+            # Пустой ответ — пробуем следующий детектор, но запоминаем: если пусто у всех, это и есть ответ
+            empty = detection
+        # Все детекторы отключены предохранителями — пусть пользователь узнает об этом сразу
+        if circuit_error is not None and not answered:
+            raise circuit_error
+        return empty
+
+    async def detect_stream(self, source, with_visualization):
+        detector = self.detectors[0]
+        return self._done(detector, await detector.detect_stream(source, with_visualization))
+
+
+detector_router = DetectorRouter([DETECTORS[name]() for name in DETECTOR_BACKENDS if name in DETECTORS])
+
+async def detect_food_in_photo(photo_bytes, file_unique_id=None, with_visualization=None):
+    """Распознает еду на фото (детекторы из DETECTOR_BACKENDS)"""
+    if with_visualization is None:
+        with_visualization = VISUALIZATION_MODE == "inline"
     try:
-        # Кодируем фото в base64
-        img_base64 = base64.b64encode(photo_bytes).decode('utf-8')
-        
-        # Формируем запрос к Workflow API
-        params = {
-            "access_key": ROBOFLOW_API_KEY,
-            "workspace": WORKSPACE_NAME
-        }
-        
-        # Тело запроса в формате base64
-        payload = {
-            "image": {
-                "type": "base64",
-                "value": img_base64
-            }
-        }
+        # Одинаковые картинки (пересланные, повторные) берем из кэша без запроса к API
+        content_hash = inference_cache.content_hash(photo_bytes)
+        cached = await inference_cache.get(content_hash=content_hash)
+        has_visualization = cached is not None and (cached.get("visualization") or cached.get("visualization_file_id"))
+        if cached is not None and (has_visualization or not with_visualization):
+            if file_unique_id:
+                await inference_cache.link(content_hash, file_unique_id)
+            return cached
         
-        # Отправляем запрос (синхронно, оборачиваем в thread)
-        def run_workflow_request():
-            response = requests.post(
-                WORKFLOW_URL,
-                params=params,
-                json=payload,
-                timeout=30
-            )
-            return response
+        detection = await detector_router.detect(photo_bytes, with_visualization)
+        if detection is not None:
+            detection["content_hash"] = content_hash
+            await inference_cache.put(content_hash, detection, file_unique_id)
+        return detection
+            
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        STAGE_ERRORS.labels("detect").inc()
+        logger.error(f"Ошибка распознавания: {e}")
+        return None
+
+class TelegramFileSource:
+    """Фото из Telegram для потоковой передачи в Workflow API.
+
+    Скачивание открывается, когда у выгрузки уже есть слот хоста, но до отправки запроса:
+    статус и размер файла проверяются заранее, и ошибка Telegram не рвет соединение с API.
+    Хэш содержимого считается по ходу передачи; байты фото не сохраняются.
+    """
+
+    def __init__(self, file_url, size=None):
+        self.file_url = file_url
+        self.size = size
+        self.content_hash = None
+        self._downloads = []
+
+    async def open(self):
+        """Открывает скачивание (каждая попытка и дубль — свое) и возвращает поток кусков"""
+        started = time.perf_counter()
+        download = None
+        try:
+            download = await telegram_files.stream("GET", self.file_url)
+            self._downloads.append(download)
+            download.raise_for_status()
+            length = download.headers.get("Content-Length")
+            if self.size is not None and length and "Content-Encoding" not in download.headers and int(length) != self.size:
+                # С другим размером не сойдется Content-Length выгрузки — отказываемся до ее отправки
+                raise ValueError(f"размер файла {length} вместо {self.size}")
+        except (httpx.HTTPError, ValueError) as e:
+            if download is not None:
+                await download.aclose()
+            record_telegram_call("download", time.perf_counter() - started)
+            record_stage("download", time.perf_counter() - started)
+            raise DownloadError(e) from e
+        return self._chunks(download, started, time.perf_counter() - started)
+
+    async def _chunks(self, download, started, waited):
+        digest = hashlib.sha256()
+        received = 0
+        resumed = time.perf_counter()
+        # waited — ожидание данных из Telegram (с заголовками ответа), без времени, пока выгрузка
+        # отправляет куски
+        try:
+            async for chunk in download.aiter_bytes(STREAM_CHUNK_SIZE):
+                waited += time.perf_counter() - resumed
+                received += len(chunk)
+                digest.update(chunk)
+                yield chunk
+                resumed = time.perf_counter()
+            if self.size is not None and received != self.size:
+                raise ValueError(f"получено {received} байт вместо {self.size}")
+        except (httpx.HTTPError, ValueError) as e:
+            raise DownloadError(e) from e
+        finally:
+            await download.aclose()
+            record_telegram_call("download", time.perf_counter() - started)
+            record_stage("download", waited)
+        self.content_hash = digest.hexdigest()
+
+    async def aclose(self):
+        """Закрывает скачивания, которые httpx не дочитал (ошибка или отмена выгрузки)"""
+        downloads, self._downloads = self._downloads, []
+        for download in downloads:
+            await download.aclose()
+
+async def detect_food_in_stream(file_url, file_unique_id=None, with_visualization=None, size=None, count_miss=True):
+    """Распознает еду, передавая файл из Telegram в Workflow API потоком.
+
+    Скачивание, base64 и отправка идут кусками по STREAM_CHUNK_SIZE, поэтому на фото
+    в полете приходится несколько десятков КБ вместо нескольких копий целого файла.
+    Хэш содержимого становится известен только после отправки, поэтому дедупликации
+    по содержимому до запроса здесь нет — только по file_unique_id (в analyze_photos).
+    count_miss=False — фото уже нашлось в кэше по file_unique_id (нужна только картинка).
+    """
+    if with_visualization is None:
+        with_visualization = VISUALIZATION_MODE == "inline"
+    # Поиск по file_unique_id в analyze_photos промах не учитывает — он учитывается здесь
+    if count_miss:
+        inference_cache.stats["misses"] += 1
+    source = TelegramFileSource(file_url, size)
+    try:
+        try:
+            detection = await detector_router.detect_stream(source, with_visualization)
+        finally:
+            await source.aclose()
         
-        # Запускаем в отдельном потоке
-        response = await asyncio.to_thread(run_workflow_request)
+        if detection is not None:
+            detection["content_hash"] = source.content_hash
+            await inference_cache.put(source.content_hash, detection, file_unique_id)
+        return detection
         
-        if response.status_code == 200:
-            result = response.json()
-            
-            # Workflow возвращает список результатов, берем первый
-            if isinstance(result, list) and len(result) > 0:
-                result_data = result[0]
-            else:
-                result_data = result
-            
-            # Извлекаем предсказания
-            predictions = result_data.get('predictions', [])
-            visualization = result_data.get('visualization', None)
-            
-            # Обрабатываем предсказания
-            detected_foods = []
-            if predictions:
-                for pred in predictions:
-                    food_name = pred.get('class', '').lower()
-                    confidence = pred.get('confidence', 0) * 100  # в процентах
-                    
-                    # Фильтруем только продукты с достаточной уверенностью
-                    if confidence > 40:  # Порог 40%
-                        detected_foods.append({
-                            "name": food_name,
-                            "confidence": round(confidence, 1),
-                            "russian_name": FOOD_DATABASE.get(food_name, {}).get("ru", food_name),
-                            "raw_prediction": pred
-                        })
-            
-            # Убираем дубликаты (берем продукт с наибольшей уверенностью)
-            unique_foods = {}
-            for food in detected_foods:
-                name = food["name"]
-                if name not in unique_foods or food["confidence"] > unique_foods[name]["confidence"]:
-                    unique_foods[name] = food
-            
-            # Возвращаем результат с визуализацией
-            return {
-                "foods": list(unique_foods.values())[:5],  # Возвращаем топ-5
-                "visualization": visualization  # base64 изображение с разметкой
-            }
-        else:
-            logger.error(f"Workflow API ошибка: {response.status_code}, {response.text}")
-            return None
-            
+    except CircuitOpenError:
+        raise
     except Exception as e:
+        STAGE_ERRORS.labels("detect").inc()
         logger.error(f"Ошибка распознавания: {e}")
         return None
 
+# ========== ВЫЗОВЫ TELEGRAM API И ПРОГРЕСС ==========
+def record_telegram_call(method, seconds):
+    """Учитывает вызов Bot API в общей статистике и в статистике текущего апдейта"""
+    telegram_api_totals.record(method, seconds)
+    stats = update_stats.get()
+    if stats is not None:
+        stats.record(method, seconds)
+
+class CountingRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API и время в них"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            # В URL есть токен — берем только имя метода
+            record_telegram_call(
+                "download" if "/file/bot" in url else url.rsplit("/", 1)[-1],
+                time.perf_counter() - started
+            )
+
+def track_telegram_calls(handler):
+    """Trace id, время обработки по этапам и вызовы Telegram API для апдейта"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        if update_stats.get() is not None:
+            # Уже внутри отслеживаемого обработчика
+            return await handler(*args, **kwargs)
+        stats = UpdateStats(trace_id=secrets.token_hex(4))
+        token = update_stats.set(stats)
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            total = time.perf_counter() - stats.started
+            HANDLER_SECONDS.labels(handler.__name__).observe(total)
+            logger.info(
+                f"{handler.__name__}: {total * 1000:.0f} мс ({stats.stage_summary()}), "
+                f"Telegram API: {stats.summary()}"
+            )
+            update_stats.reset(token)
+    return wrapper
+
+class ProgressReporter:
+    """Индикация прогресса без лишних вызовов Telegram API.
+
+    Пока обработка быстрая, пользователь видит только chat action ("отправляет фото...").
+    Статусное сообщение появляется через PROGRESS_MESSAGE_DELAY секунд (или сразу для
+    срочного текста, например позиции в очереди), промежуточные тексты схлопываются
+    и правятся не чаще PROGRESS_EDIT_INTERVAL. Все это идет фоновой задачей
+    параллельно со скачиванием и распознаванием.
+    """
+
+    def __init__(self, message, action=ChatAction.TYPING,
+                 delay=PROGRESS_MESSAGE_DELAY, interval=PROGRESS_EDIT_INTERVAL):
+        self.message = message
+        self.action = action
+        self.delay = delay
+        self.interval = interval
+        self.status = None  # статусное сообщение, если уже отправлено
+        self._text = None
+        self._shown = None
+        self._urgent = False
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    def update(self, text, urgent=False):
+        """Новый текст статуса; не ждет отправки, предыдущий неотправленный текст заменяется"""
+        self._text = text
+        self._urgent = self._urgent or urgent
+        self._wake.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        next_action = started
+        last_edit = -math.inf
+        while not self._stopping:
+            now = loop.time()
+            # "Печатает..." нужен, только пока нет статусного сообщения
+            if self.status is None and now >= next_action:
+                try:
+                    await self.message.get_bot().send_chat_action(self.message.chat_id, self.action)
+                except Exception as e:
+                    logger.warning(f"Не удалось отправить chat action: {e}")
+                next_action = now + CHAT_ACTION_INTERVAL
+                continue
+            
+            wake_at = next_action if self.status is None else math.inf
+            if self._text is not None and self._text != self._shown:
+                ready_at = max(now if self._urgent else started + self.delay, last_edit + self.interval)
+                if now >= ready_at:
+                    text = self._text
+                    try:
+                        if self.status is None:
+                            # Статус потом становится отчетом, поэтому тоже цитирует фото (см. show_visualization)
+                            self.status = await self.message.reply_text(text, parse_mode="Markdown", do_quote=True)
+                        else:
+                            await self.status.edit_text(text, parse_mode="Markdown")
+                    except Exception as e:
+                        logger.warning(f"Не удалось обновить статус: {e}")
+                    self._shown = text
+                    self._urgent = False
+                    last_edit = loop.time()
+                    continue
+                wake_at = min(wake_at, ready_at)
+            
+            self._wake.clear()
+            timeout = None if wake_at == math.inf else max(0.0, wake_at - loop.time())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        """Останавливает индикацию (перед отправкой итогового ответа)"""
+        if self._task is not None:
+            task, self._task = self._task, None
+            # Не обрываем запрос на полпути (это рвет соединение пула), а дожидаемся его:
+            # иначе chat action может прийти уже после ответа
+            self._stopping = True
+            self._wake.set()
+            await task
+
+    async def finish(self, text, **kwargs):
+        """Итоговый текст: правкой статусного сообщения, а если его нет — одним ответом"""
+        await self.stop()
+        if self.status is not None:
+            try:
+                return await self.status.edit_text(text, **kwargs)
+            except Exception as e:
+                logger.warning(f"Не удалось отредактировать статус: {e}")
+        # Ответ цитирует фото и в личных чатах — по нему кнопка "Показать разметку" находит исходник
+        return await self.message.reply_text(text, do_quote=True, **kwargs)
+
+    async def discard(self):
+        """Удаляет статусное сообщение после отправки итогового ответа"""
+        await self.stop()
+        if self.status is not None:
+            status, self.status = self.status, None
+            try:
+                await status.delete()
+            except Exception as e:
+                logger.warning(f"Не удалось удалить статус: {e}")
+
 # ========== ОБРАБОТЧИКИ TELEGRAM ==========
+@track_telegram_calls
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     welcome_text = """
@@ -154,6 +2542,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 *Определение калорий* - для 35+ видов еды
 🔍 *Текстовый поиск* - отправьте название продукта
 🖼 *Визуализация* - покажу разметку на фото
+📔 *Дневник питания* - итоги за день и неделю: /today, /week
 
 *Отправьте мне фото еды для анализа!*
 """
@@ -161,23 +2550,233 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка фото"""
+    # Фото из альбома собираем в пачку: один анализ и один ответ на весь альбом
+    if update.message.media_group_id:
+        media_groups.add(
+            update.message,
+            analyze_photos,
+            lambda coro: context.application.create_task(coro, update=update)
+        )
+        return
+    
+    await analyze_photos([update.message])
+
+def build_report(detected_foods):
+    """Формирует текстовый отчет о калорийности по списку распознанных продуктов"""
+    response_text = "🍽 *Результаты анализа:*\n\n"
+    
+    # Считаем количество каждого типа еды
+    food_counter = Counter()
+    for food in detected_foods:
+        food_counter[food['name']] += 1
+    
+    total_calories = 0
+    for i, (food_name, count) in enumerate(food_counter.items(), 1):
+        # Получаем информацию о продукте
+        food_info = food_database.get(food_name)
+        ru_name = food_info.ru if food_info else food_name
+        calories = food_info.calories if food_info else UNKNOWN_FOOD_CALORIES
+        
+        # Находим максимальную уверенность для этого типа
+        max_conf = max([f['confidence'] for f in detected_foods if f['name'] == food_name])
+        
+        response_text += f"*{i}. {ru_name.capitalize()}* ({count} шт.)\n"
+        response_text += f"   🔍 Уверенность: {max_conf}%\n"
+        response_text += f"   🔥 Калории: *{calories}* ккал/100г\n\n"
+        
+        total_calories += calories * count
+    
+    # Добавляем общий подсчет
+    total_items = sum(food_counter.values())
+    if total_items > 0:
+        response_text += f"📊 *Общая статистика:*\n"
+        response_text += f"• Всего объектов: {total_items}\n"
+        response_text += f"• Уникальных типов: {len(food_counter)}\n"
+        response_text += f"• Примерная калорийность: *{total_calories} ккал*\n\n"
+    
+    # Добавляем примечания
+    response_text += (
+        "⚠️ *Важно:*\n"
+        "• Данные приблизительные\n"
+        "• Указано на 100г продукта\n"
+        "• Фактическая калорийность зависит от рецепта\n"
+        "• Для точности используйте кухонные весы"
+    )
+    return response_text
+
+def decode_visualization(visualization):
+    """Декодирует base64-визуализацию из ответа Workflow API с минимумом копий"""
+    # Новые версии Workflow API отдают {"type": "base64", "value": "..."}
+    if isinstance(visualization, dict):
+        visualization = visualization.get("value", "")
+    
+    # Префикс data URL ("data:image/jpeg;base64,") отрезаем только если он есть
+    if visualization.startswith("data:"):
+        visualization = visualization[visualization.find(",") + 1:]
+    
+    # a2b_base64 читает ASCII-строку напрямую, без промежуточного .encode()
+    return binascii.a2b_base64(visualization)
+
+def service_unavailable_text(retry_after):
+    """Ответ, когда Workflow API недоступен и предохранитель разомкнут"""
+    return (
+        "⚠️ *Сервис распознавания временно недоступен*\n\n"
+        f"Попробуйте отправить фото через {max(1, math.ceil(retry_after))} сек\n"
+        "или напишите название продукта текстом"
+    )
+
+def can_stream(photo, photo_file):
+    """Можно ли отправить фото в API потоком, без скачивания целиком и уменьшения"""
+    return (
+        STREAM_UPLOADS
+        # Для локальной отрисовки байты фото нужны целиком: такое фото скачиваем и до запроса
+        # проверяем кэш по хэшу содержимого — поток этой дедупликации не дает
+        and VISUALIZATION_MODE != "local"
+        and detector_router.streamable
+        and max(photo.width, photo.height) <= IMAGE_MAX_SIDE
+        # Локальный Bot API сервер отдает путь к файлу, а не URL
+        and (photo_file.file_path or "").startswith(("http://", "https://"))
+    )
+
+def needs_photo_bytes(result):
+    """Нужно ли скачивать фото, хотя результат распознавания уже в кэше"""
+    if result.get("visualization_file_id") or not result.get("foods"):
+        return False
+    if VISUALIZATION_MODE == "inline":
+        return not result.get("visualization")
+    if VISUALIZATION_MODE == "local":
+        # Рамки рисуем по байтам фото; повторный анализ попадет в кэш по хэшу без запроса к API
+        return bool(result.get("boxes")) and not result.get("visualization")
+    return False
+
+async def visualization_media(result, photo_bytes=None):
+    """Картинка с разметкой для ответа: file_id уже отправленной, серверная или нарисованная локально"""
+    if result.get("visualization_file_id"):
+        return result["visualization_file_id"]
+    if result.get("visualization"):
+        with stage_timer("decode_visualization"):
+            return decode_visualization(result["visualization"])
+    if photo_bytes is not None and result.get("boxes"):
+        try:
+            with stage_timer("render"):
+                return await box_renderer.render(photo_bytes, result["boxes"])
+        except Exception as e:
+            logger.error(f"Ошибка отрисовки разметки: {e}")
+    return None
+
+async def remember_visualizations(results, sent_messages):
+    """Запоминает file_id отправленных картинок: повторный ответ обойдется без отрисовки и загрузки"""
+    for result, sent in zip(results, sent_messages):
+        if not sent.photo or result.get("visualization_file_id") or not result.get("content_hash"):
+            continue
+        result["visualization_file_id"] = sent.photo[-1].file_id
+        # Серверная картинка больше не нужна — Telegram хранит ее у себя
+        result.pop("visualization", None)
+        await inference_cache.put(result["content_hash"], result)
+
+@track_telegram_calls
+async def analyze_photos(messages):
+    """Анализ одного фото или целого альбома с одним итоговым ответом"""
+    first = messages[0]
+    # Индикация идет параллельно с работой: chat action сразу, статус — только если долго
+    action = ChatAction.UPLOAD_PHOTO if VISUALIZATION_MODE in ("inline", "local") else ChatAction.TYPING
+    progress = ProgressReporter(first, action).start()
     try:
-        # Отправляем сообщение о начале обработки
-        message = await update.message.reply_text("🔄 *Анализирую фото...*\n\nПодождите 10-20 секунд...", parse_mode="Markdown")
+        if len(messages) == 1:
+            progress.update("🔄 *Анализирую фото...*\n\nПодождите 10-20 секунд...")
+        else:
+            progress.update(f"🔄 *Анализирую альбом ({len(messages)} фото)...*\n\nПодождите 10-20 секунд...")
         
-        # Получаем фото (самое большое качество)
-        photo_file = await update.message.photo[-1].get_file()
+        # Берем самую маленькую версию каждого фото, которой достаточно для детектора
+        photos = [select_photo_size(m.photo) for m in messages]
         
-        # Скачиваем фото как bytes
-        photo_bytes = await photo_file.download_as_bytearray()
+        # Уже распознанные фото отдаем из кэша без скачивания и запроса к API
+        with stage_timer("cache_lookup"):
+            results = list(await asyncio.gather(
+                *(inference_cache.get(file_unique_id=photo.file_unique_id) for photo in photos)
+            ))
+        # Скачиваем фото, которых нет в кэше или для которых еще нет картинки с разметкой
+        missing = [i for i, result in enumerate(results) if result is None or needs_photo_bytes(result)]
+        photo_data = [None] * len(photos)
         
-        # Распознаем еду на фото
-        await message.edit_text("🤖 *Распознаю еду на фото...*", parse_mode="Markdown")
+        if missing:
+            # Все детекторы отключены предохранителем — отвечаем сразу, не скачивая фото
+            retry_after = detector_router.retry_after()
+            if retry_after is not None:
+                await progress.finish(service_unavailable_text(retry_after), parse_mode="Markdown")
+                return
+            
+            async def analyze_photo(photo, cached):
+                with stage_timer("get_file"):
+                    photo_file = await photo.get_file()
+                keep_bytes = VISUALIZATION_MODE == "local"
+                
+                # Фото не больше IMAGE_MAX_SIDE уменьшать не нужно — передаем его в API потоком
+                if can_stream(photo, photo_file):
+                    # Результат из кэша без картинки — это попадание, а не промах
+                    result = await detect_food_in_stream(
+                        photo_file.file_path, photo.file_unique_id, size=photo_file.file_size,
+                        count_miss=cached is None
+                    )
+                    return result, None
+                
+                # Скачиваем фото как bytes и при необходимости уменьшаем
+                with stage_timer("download"):
+                    photo_bytes = await photo_file.download_as_bytearray()
+                with stage_timer("prepare"):
+                    photo_bytes = await prepare_image(photo_bytes)
+                
+                result = await detect_food_in_photo(photo_bytes, photo.file_unique_id)
+                # Байты фото нужны дальше только для локальной отрисовки рамок
+                return result, photo_bytes if keep_bytes else None
+            
+            async def analyze_batch():
+                # Распознаем еду на фото (фото альбома — параллельно, но не больше ALBUM_CONCURRENCY сразу)
+                progress.update("🤖 *Распознаю еду на фото...*")
+                limit = asyncio.Semaphore(ALBUM_CONCURRENCY)
+                
+                async def limited(photo, cached):
+                    async with limit:
+                        return await analyze_photo(photo, cached)
+                
+                return await asyncio.gather(*(limited(photos[i], results[i]) for i in missing))
+            
+            # Ставим распознавание в общую очередь (лимит параллельности и честность между чатами)
+            try:
+                job, position = inference_scheduler.submit(
+                    first.chat_id, analyze_batch, message_id=max(m.message_id for m in messages)
+                )
+            except QueueFullError:
+                await progress.finish(
+                    "🚦 *Сейчас слишком много запросов*\n\n"
+                    "Попробуйте отправить фото через минуту",
+                    parse_mode="Markdown"
+                )
+                return
+            
+            if position:
+                # Ожидание в очереди — повод показать статус сразу
+                progress.update(
+                    f"⏳ *Фото в очереди: позиция {position}*\n\nПодождите немного...",
+                    urgent=True
+                )
+            
+            try:
+                for i, (result, photo_bytes) in zip(missing, await job):
+                    results[i] = result
+                    photo_data[i] = photo_bytes
+            except StaleJobError:
+                # Пользователь прислал новое фото — старое больше не анализируем
+                await progress.finish("⏭ *Пропущено* — анализирую более новое фото", parse_mode="Markdown")
+                return
+            except CircuitOpenError as e:
+                await progress.finish(service_unavailable_text(e.retry_after), parse_mode="Markdown")
+                return
         
-        result = await detect_food_in_photo(photo_bytes)
+        detected_foods = [food for result in results if result for food in result.get("foods", [])]
         
-        if not result or not result.get("foods"):
-            await message.edit_text(
+        if not detected_foods:
+            await progress.finish(
                 "❌ *Не удалось распознать еду*\n\n"
                 "*Возможные причины:*\n"
                 "• Еда плохо видна на фото\n"
@@ -191,86 +2790,85 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        detected_foods = result["foods"]
-        visualization = result.get("visualization")
-        
         # Формируем текстовый отчет
-        await message.edit_text("📊 *Определяю калорийность...*", parse_mode="Markdown")
-        
-        response_text = "🍽 *Результаты анализа:*\n\n"
+        response_text = build_report(detected_foods)
+        # Запись в дневник только ставится в очередь — ответ не ждет диска
+        user_id = first.from_user.id if first.from_user else first.chat_id
+        # Ключ фото: пересланное или повторно отправленное фото (тот же file_unique_id, ответ из кэша)
+        # не прибавляется к итогам дня второй раз — и ответ об этом честно говорит
+        photo_key = ",".join(sorted(photo.file_unique_id for photo in photos))
+        eaten_at = first.date.timestamp()
+        if await meal_diary.contains(user_id, eaten_at, photo_key):
+            response_text += "\n\n📔 Это фото уже есть в дневнике за сегодня: /today"
+        elif meal_diary.record(user_id, eaten_at, detected_foods, photo_key):
+            response_text += "\n\n📔 Записано в дневник: /today"
         
-        # Считаем количество каждого типа еды
-        from collections import Counter
-        food_counter = Counter()
-        for food in detected_foods:
-            food_counter[food['name']] += 1
-        
-        total_calories = 0
-        for i, (food_name, count) in enumerate(food_counter.items(), 1):
-            # Получаем информацию о продукте
-            food_info = FOOD_DATABASE.get(food_name, {"ru": food_name, "calories": 200})
-            ru_name = food_info.get("ru", food_name)
-            
-            # Находим максимальную уверенность для этого типа
-            max_conf = max([f['confidence'] for f in detected_foods if f['name'] == food_name])
-            
-            response_text += f"*{i}. {ru_name.capitalize()}* ({count} шт.)\n"
-            response_text += f"   🔍 Уверенность: {max_conf}%\n"
-            response_text += f"   🔥 Калории: *{food_info.get('calories', 200)}* ккал/100г\n\n"
-            
-            total_calories += food_info.get('calories', 200) * count
-        
-        # Добавляем общий подсчет
-        total_items = sum(food_counter.values())
-        if total_items > 0:
-            response_text += f"📊 *Общая статистика:*\n"
-            response_text += f"• Всего объектов: {total_items}\n"
-            response_text += f"• Уникальных типов: {len(food_counter)}\n"
-            response_text += f"• Примерная калорийность: *{total_calories} ккал*\n\n"
-        
-        # Добавляем примечания
-        response_text += (
-            "⚠️ *Важно:*\n"
-            "• Данные приблизительные\n"
-            "• Указано на 100г продукта\n"
-            "• Фактическая калорийность зависит от рецепта\n"
-            "• Для точности используйте кухонные весы"
-        )
+        # Картинки с разметкой: серверные (inline) или нарисованные локально (local)
+        images = []
+        if VISUALIZATION_MODE in ("inline", "local"):
+            shown = [(r, b) for r, b in zip(results, photo_data) if r and r.get("foods")]
+            media = await asyncio.gather(*(visualization_media(r, b) for r, b in shown))
+            images = [(r, m) for (r, _), m in zip(shown, media) if m is not None]
         
         # Если есть визуализация, отправляем фото с результатами
-        if visualization:
+        if images:
+            await progress.stop()
+            # Длинный отчет (много продуктов в альбоме) в подпись не влезет — шлем его отдельно.
+            # Считаем вместе с Markdown-разметкой: с запасом, зато без разбора сущностей
+            caption = response_text if len(response_text.encode("utf-16-le")) // 2 <= CAPTION_MAX_LENGTH else None
             try:
-                # Извлекаем base64 данные
-                if ',' in visualization:
-                    img_data = visualization.split(',')[1]
-                else:
-                    img_data = visualization
-                
-                # Декодируем base64
-                img_bytes = base64.b64decode(img_data)
-                
-                # Удаляем сообщение "Определяю калорийность"
-                await message.delete()
-                
-                # Отправляем визуализацию с подписью
-                await update.message.reply_photo(
-                    photo=BytesIO(img_bytes),
-                    caption=response_text,
-                    parse_mode="Markdown"
-                )
-                return
-                
+                # Отправляем визуализацию с подписью (для альбома — одной группой)
+                with stage_timer("reply"):
+                    if len(images) == 1:
+                        sent = [await first.reply_photo(
+                            photo=images[0][1],
+                            caption=caption,
+                            parse_mode="Markdown" if caption else None
+                        )]
+                    else:
+                        sent = await first.reply_media_group(
+                            media=[
+                                InputMediaPhoto(
+                                    img,
+                                    caption=caption if i == 0 else None,
+                                    parse_mode="Markdown" if i == 0 and caption else None
+                                )
+                                for i, (_, img) in enumerate(images[:10])
+                            ]
+                        )
             except Exception as e:
                 logger.error(f"Ошибка обработки визуализации: {e}")
                 # Если не удалось отправить фото, отправляем текст
-                await message.edit_text(response_text, parse_mode="Markdown")
+                await progress.finish(response_text, parse_mode="Markdown")
+                return
+            
+            if caption is None:
+                # Отчет — отдельным сообщением после картинок (правкой статуса, если он есть)
+                with stage_timer("reply"):
+                    await progress.finish(response_text, parse_mode="Markdown")
+            else:
+                # Статус (если успел появиться) убираем уже после ответа — не на критическом пути
+                await progress.discard()
+            await remember_visualizations([r for r, _ in images], sent)
+        elif VISUALIZATION_MODE == "on_demand" and len(messages) == 1:
+            # Разметку рисуем только по кнопке, чтобы не гонять картинку для каждого фото
+            with stage_timer("reply"):
+                await progress.finish(
+                    response_text,
+                    parse_mode="Markdown",
+                    reply_markup=InlineKeyboardMarkup(
+                        [[InlineKeyboardButton("🖼 Показать разметку", callback_data=VISUALIZATION_CALLBACK)]]
+                    )
+                )
         else:
             # Если нет визуализации, отправляем только текст
-            await message.edit_text(response_text, parse_mode="Markdown")
+            with stage_timer("reply"):
+                await progress.finish(response_text, parse_mode="Markdown")
         
     except Exception as e:
+        STAGE_ERRORS.labels("analyze_photos").inc()
         logger.error(f"Ошибка обработки фото: {e}")
-        await update.message.reply_text(
+        await progress.finish(
             "❌ *Произошла ошибка при обработке фото*\n\n"
             "Попробуйте:\n"
             "1. Отправить фото еще раз\n"
@@ -278,7 +2876,66 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "3. Отправить название продукта текстом",
             parse_mode="Markdown"
         )
+    finally:
+        await progress.stop()
+
+@track_telegram_calls
+async def show_visualization(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка "Показать разметку": рисует рамки на исходном фото"""
+    query = update.callback_query
+    # Отчет отправлен ответом на фото пользователя — берем фото оттуда, без хранения состояния.
+    # В личных чатах PTB 21 не цитирует ответы сам, поэтому отчет всегда шлется с do_quote=True
+    source = query.message.reply_to_message if query.message else None
+    if source is None or not source.photo:
+        await query.answer("Исходное фото недоступно", show_alert=True)
+        return
+    await query.answer("🖼 Рисую разметку...")
+    
+    photo = select_photo_size(source.photo)
+    
+    async def render():
+        result = await inference_cache.get(file_unique_id=photo.file_unique_id)
+        if result and result.get("visualization_file_id"):
+            return result, result["visualization_file_id"]
+        photo_file = await photo.get_file()
+        photo_bytes = await prepare_image(await photo_file.download_as_bytearray())
+        # Фото уже распознано при анализе — результат берется из кэша по хэшу
+        result = await detect_food_in_photo(photo_bytes, photo.file_unique_id)
+        return result, await visualization_media(result, photo_bytes) if result else None
+    
+    # Пока рисуем — только "отправляет фото...", без статусных сообщений
+    progress = ProgressReporter(source, ChatAction.UPLOAD_PHOTO).start()
+    try:
+        # Свой ключ очереди у каждого отчета: кнопка не отменяет анализ нового фото в этом чате,
+        # а нажатие под другим отчетом — уже начатую отрисовку (иначе ее картинка потерялась бы)
+        job, _ = inference_scheduler.submit(
+            (source.chat_id, "visualization", query.message.message_id), render,
+            message_id=query.message.message_id
+        )
+        result, media = await job
+    except QueueFullError:
+        await progress.finish("🚦 *Сейчас слишком много запросов*, попробуйте через минуту", parse_mode="Markdown")
+        return
+    except CircuitOpenError as e:
+        await progress.finish(service_unavailable_text(e.retry_after), parse_mode="Markdown")
+        return
+    except StaleJobError:
+        return
+    finally:
+        await progress.stop()
+    
+    if media is None:
+        await source.reply_text("❌ Не удалось построить разметку", parse_mode="Markdown")
+        return
+    
+    # Кнопка больше не нужна; убираем ее параллельно с отправкой картинки
+    sent, _ = await asyncio.gather(
+        source.reply_photo(photo=media),
+        query.edit_message_reply_markup(reply_markup=None)
+    )
+    await remember_visualizations([result], [sent])
 
+@track_telegram_calls
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка текстовых сообщений"""
     text = update.message.text.lower().strip()
@@ -300,8 +2957,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for category, foods in categories.items():
             response += f"*{category}:*\n"
             for food in foods:
-                if food in FOOD_DATABASE:
-                    ru_name = FOOD_DATABASE[food]["ru"]
+                if food in food_database:
+                    ru_name = food_database[food].ru
                     response += f"• {ru_name}\n"
             response += "\n"
         
@@ -315,6 +2972,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• Отправьте *фото еды* для анализа\n"
             "• Отправьте *название продукта* текстом\n"
             "• /list - список всех продуктов\n"
+            "• /today - дневник питания за сегодня\n"
+            "• /week - итоги недели по дням\n"
             "• /start - начать заново\n\n"
             "Бот использует AI для распознавания еды! 🤖",
             parse_mode="Markdown"
@@ -324,37 +2983,32 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await start(update, context)
         
     else:
-        # Ищем продукт в базе
-        found = False
-        for eng_name, food_info in FOOD_DATABASE.items():
-            if text in food_info["ru"] or text == eng_name:
-                response = f"""
-📊 *{food_info['ru'].capitalize()}*
+        # Ищем продукт по индексу (точное название, синоним или начало слов)
+        key = food_database.index.lookup(text)
+        if key is not None:
+            food_info = food_database[key]
+            response = f"""
+📊 *{food_info.ru.capitalize()}*
 
 *Пищевая ценность на 100г:*
-🔥 Калории: *{food_info['calories']} ккал*
-🥚 Белки: {food_info['protein']}г
-🥑 Жиры: {food_info['fat']}г
-🍞 Углеводы: {food_info['carbs']}г
+🔥 Калории: *{food_info.calories} ккал*
+🥚 Белки: {food_info.protein}г
+🥑 Жиры: {food_info.fat}г
+🍞 Углеводы: {food_info.carbs}г
 
 *Расчет для вашей порции:*
 1. Взвесьте продукт в граммах
-2. Формула: (вес / 100) × {food_info['calories']}
-3. Пример: 250г = {food_info['calories'] * 2.5:.0f} ккал
+2. Формула: (вес / 100) × {food_info.calories}
+3. Пример: 250г = {food_info.calories * 2.5:.0f} ккал
 """
-                await update.message.reply_text(response, parse_mode="Markdown")
-                found = True
-                break
+            await update.message.reply_text(response, parse_mode="Markdown")
         
-        if not found:
-            # Показываем похожие продукты
-            similar = []
-            for eng_name, food_info in FOOD_DATABASE.items():
-                if text in food_info["ru"] or any(word in food_info["ru"] for word in text.split()):
-                    similar.append(food_info["ru"])
+        else:
+            # Показываем похожие продукты (нечеткий поиск с ранжированием)
+            similar = [food_database[k].ru for k in food_database.index.suggest(text, limit=5)]
             
             if similar:
-                suggestions = "\n".join([f"• {s}" for s in similar[:5]])
+                suggestions = "\n".join([f"• {s}" for s in similar])
                 await update.message.reply_text(
                     f"🤔 *'{text}' не найден*\n\n"
                     f"*Похожие продукты:*\n{suggestions}\n\n"
@@ -371,6 +3025,70 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode="Markdown"
                 )
 
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+def diary_user_and_day(update):
+    message = update.message
+    user_id = update.effective_user.id if update.effective_user else message.chat_id
+    return user_id, diary_day(message.date.timestamp())
+
+@track_telegram_calls
+async def show_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /today: итоги дня из дневника"""
+    if not meal_diary.enabled:
+        await update.message.reply_text("📔 Дневник питания отключен")
+        return
+    user_id, day = diary_user_and_day(update)
+    totals = await meal_diary.day_totals(user_id, day)
+    if totals is None:
+        await update.message.reply_text(
+            "📔 *Сегодня записей нет*\n\n"
+            "Отправьте фото еды — результат попадет в дневник",
+            parse_mode="Markdown"
+        )
+        return
+    await update.message.reply_text(
+        f"📔 *Сегодня, {date.fromordinal(day):%d.%m}*\n\n"
+        f"🍽 Приемов пищи: {totals['meals']}\n"
+        f"🔥 Калории: *{totals['calories']:.0f} ккал*\n"
+        f"🥚 Белки: {totals['protein']:.0f}г\n"
+        f"🥑 Жиры: {totals['fat']:.0f}г\n"
+        f"🍞 Углеводы: {totals['carbs']:.0f}г\n\n"
+        "⚠️ Оценка по 100г на каждый распознанный продукт",
+        parse_mode="Markdown"
+    )
+
+@track_telegram_calls
+async def show_week(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /week: итоги текущей недели по дням"""
+    if not meal_diary.enabled:
+        await update.message.reply_text("📔 Дневник питания отключен")
+        return
+    user_id, day = diary_user_and_day(update)
+    week = diary_week(day)
+    totals, days = await meal_diary.week_totals(user_id, week)
+    monday = date.fromordinal(week * 7 + 1)
+    header = f"📅 *Неделя {monday:%d.%m} – {monday + timedelta(days=6):%d.%m}*\n\n"
+    if totals is None:
+        await update.message.reply_text(
+            header + "Записей пока нет — отправьте фото еды",
+            parse_mode="Markdown"
+        )
+        return
+    lines = "\n".join(
+        f"• {WEEKDAYS[(d - 1) % 7]} {date.fromordinal(d):%d.%m} — {calories:.0f} ккал ({meals})"
+        for d, meals, calories in days
+    )
+    await update.message.reply_text(
+        header + lines + "\n\n"
+        f"🍽 Приемов пищи: {totals['meals']}\n"
+        f"🔥 Калории: *{totals['calories']:.0f} ккал* (в среднем {totals['calories'] / len(days):.0f} за день)\n"
+        f"🥚 Белки: {totals['protein']:.0f}г\n"
+        f"🥑 Жиры: {totals['fat']:.0f}г\n"
+        f"🍞 Углеводы: {totals['carbs']:.0f}г",
+        parse_mode="Markdown"
+    )
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Ошибка: {context.error}")
@@ -383,7 +3101,193 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         pass
 
+# ========== WEBHOOK-СЕРВЕР ==========
+APPLICATION_KEY = web.AppKey("application", Application)
+SECRET_KEY = web.AppKey("secret", str)
+
+async def receive_update(request):
+    """Прием апдейта от Telegram: проверка секрета и постановка в очередь Application"""
+    application = request.app[APPLICATION_KEY]
+    secret = request.app[SECRET_KEY]
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if secret and not hmac.compare_digest(token, secret):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+    # Отвечаем сразу: обработку ведут воркеры Application (UPDATE_WORKERS одновременно)
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+async def liveness(request):
+    """Health-check для балансировщика на публичном порту: только статус, без счетчиков"""
+    application = request.app[APPLICATION_KEY]
+    if application.running:
+        return web.json_response({"status": "ok"})
+    return web.json_response({"status": "starting"}, status=503)
+
+async def health(request):
+    """Подробный health-check со счетчиками (служебный порт)"""
+    application = request.app[APPLICATION_KEY]
+    status = {
+        "status": "ok" if application.running else "starting",
+        "mode": BOT_MODE,
+        "update_queue": application.update_queue.qsize(),
+        "inference_queue": inference_scheduler.depth,
+        "inference_busy": inference_scheduler.busy,
+        "detectors": detector_router.names,
+        "detections": dict(detector_router.stats),
+        "detector_metrics": detector_router.metrics(),
+        "telegram_api_calls": dict(telegram_api_totals.calls),
+        "telegram_api_seconds": round(telegram_api_totals.seconds, 3),
+        "diary": dict(meal_diary.stats),
+    }
+    return web.json_response(status, status=200 if application.running else 503)
+
+async def metrics(request):
+    """Метрики в формате Prometheus"""
+    return web.Response(body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+def build_web_app(application, webhook_path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    """Публичное aiohttp-приложение: webhook-эндпоинт и статусный /healthz"""
+    web_app = web.Application(client_max_size=WEBHOOK_MAX_BODY)
+    web_app[APPLICATION_KEY] = application
+    web_app[SECRET_KEY] = secret
+    web_app.router.add_post(webhook_path, receive_update)
+    web_app.router.add_get("/healthz", liveness)
+    return web_app
+
+def build_service_app(application):
+    """Служебное aiohttp-приложение с /healthz и /metrics (внутренние счетчики наружу не отдаем)"""
+    web_app = web.Application()
+    web_app[APPLICATION_KEY] = application
+    web_app.router.add_get("/healthz", health)
+    web_app.router.add_get("/metrics", metrics)
+    return web_app
+
+async def run_webhook(application, public_url=WEBHOOK_URL, host=WEBHOOK_HOST, port=PORT, secret=WEBHOOK_SECRET):
+    """Запуск в режиме webhook: встроенный HTTP-сервер вместо long polling"""
+    shared_secret = bool(secret)
+    if not secret:
+        # Без общего секрета несколько инстансов перезапишут друг другу webhook
+        secret = secrets.token_urlsafe(32)
+        logger.warning("⚠️ WEBHOOK_SECRET не задан — сгенерирован случайный (подходит только для одного инстанса)")
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
+    runner = web.AppRunner(build_web_app(application, secret=secret), access_log=None)
+    await runner.setup()
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if public_url:
+            webhook_url = public_url.rstrip("/") + WEBHOOK_PATH
+            info = await application.bot.get_webhook_info()
+            # Webhook уже зарегистрирован другим инстансом — не трогаем его при перезапуске и деплое.
+            # Секрет getWebhookInfo не возвращает: после смены WEBHOOK_SECRET задайте WEBHOOK_DROP_PENDING=1
+            # или удалите webhook (deleteWebhook), чтобы его зарегистрировали заново
+            if shared_secret and not WEBHOOK_DROP_PENDING and info.url == webhook_url:
+                logger.info(f"Webhook уже установлен: {webhook_url} (ожидают {info.pending_update_count} апдейтов)")
+            else:
+                await application.bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=secret,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=WEBHOOK_DROP_PENDING,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS
+                )
+        await application.start()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Webhook-сервер слушает {host}:{port}{WEBHOOK_PATH}")
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def start_metrics_server(application, host=METRICS_HOST, port=METRICS_PORT):
+    """Отдельный HTTP-сервер с /metrics и /healthz (в обоих режимах)"""
+    runner = web.AppRunner(build_service_app(application), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики: http://{host}:{port}/metrics")
+    return runner
+
 # ========== ЗАПУСК БОТА ==========
+async def on_startup(app: Application):
+    """Инициализация ресурсов при старте приложения"""
+    metrics_collector.application = app
+    if METRICS_PORT:
+        app.bot_data["metrics_runner"] = await start_metrics_server(app)
+    await inference_client.start()
+    await telegram_files.start()
+    await inference_cache.prune()
+    inference_cache.start_pruning()
+    await inference_scheduler.start()
+    await detector_router.start()
+    await meal_diary.start()
+    box_renderer.start()
+    food_database.start_watching()
+
+async def on_shutdown(app: Application):
+    """Освобождение ресурсов при остановке приложения"""
+    await food_database.stop_watching()
+    await inference_cache.stop_pruning()
+    await inference_scheduler.stop()
+    await detector_router.stop()
+    await meal_diary.stop()
+    box_renderer.stop()
+    await inference_client.close()
+    await telegram_files.close()
+    logger.info(f"Кэш распознавания: {inference_cache.summary()}")
+    logger.info(f"Telegram API за время работы: {telegram_api_totals.summary()}")
+    runner = app.bot_data.pop("metrics_runner", None)
+    if runner is not None:
+        await runner.cleanup()
+
+def build_application(token, base_url=None, base_file_url=None):
+    """Создает Application со всеми обработчиками"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(UPDATE_WORKERS)
+        # Считаем вызовы Bot API (getUpdates идет отдельным клиентом и не учитывается)
+        .request(CountingRequest(connection_pool_size=256))
+    )
+    # Другой адрес Bot API (локальный сервер или фейковый Telegram в бенчмарках)
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    app = builder.build()
+    
+    # Регистрируем обработчики
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("list", handle_text))
+    app.add_handler(CommandHandler("help", handle_text))
+    app.add_handler(CommandHandler("today", show_today))
+    app.add_handler(CommandHandler("week", show_week))
+    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(CallbackQueryHandler(show_visualization, pattern=f"^{VISUALIZATION_CALLBACK}$"))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_error_handler(error_handler)
+    return app
+
 def main():
     """Основная функция"""
     TOKEN = os.getenv("TELEGRAM_TOKEN", "")
@@ -393,20 +3297,33 @@ def main():
         print("❌ Добавьте TELEGRAM_TOKEN в переменные окружения")
         return
     
-    if not ROBOFLOW_API_KEY:
+    unknown = [name for name in DETECTOR_BACKENDS if name not in DETECTORS]
+    if unknown or not DETECTOR_BACKENDS:
+        logger.error(f"❌ Неизвестные детекторы: {unknown}")
+        print("❌ DETECTOR_BACKENDS — список через запятую из remote и local, например remote,local")
+        return
+    
+    if "remote" in DETECTOR_BACKENDS and not ROBOFLOW_API_KEY:
         logger.warning("⚠️ ROBOFLOW_API_KEY не установлен. Распознавание фото не будет работать.")
         print("⚠️ Для распознавания фото добавьте ROBOFLOW_API_KEY")
     
-    # Создаем приложение
-    app = Application.builder().token(TOKEN).build()
+    if BOT_MODE not in ("polling", "webhook"):
+        logger.error(f"❌ Неизвестный BOT_MODE: {BOT_MODE}")
+        print("❌ BOT_MODE должен быть polling или webhook")
+        return
     
-    # Регистрируем обработчики
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("list", handle_text))
-    app.add_handler(CommandHandler("help", handle_text))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    app.add_error_handler(error_handler)
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("❌ WEBHOOK_URL не установлен")
+        print("❌ Для режима webhook добавьте WEBHOOK_URL (публичный https-адрес бота)")
+        return
+    
+    if BOT_MODE == "webhook" and METRICS_PORT == PORT:
+        logger.error("❌ METRICS_PORT совпадает с PORT")
+        print("❌ /metrics и подробный /healthz не отдаются на публичном порту — укажите другой METRICS_PORT")
+        return
+    
+    # Создаем приложение
+    app = build_application(TOKEN)
     
     # Запускаем бота
     logger.info("🤖 Бот запущен с распознаванием фото через Workflow API!")
@@ -419,14 +3336,14 @@ def main():
     print("=" * 50)
     print(f"🌐 Workspace: {WORKSPACE_NAME}")
     print(f"⚙️ Workflow: {WORKFLOW_ID}")
+    print(f"📡 Режим: {BOT_MODE}")
+    print(f"🧠 Детекторы: {', '.join(DETECTOR_BACKENDS)}")
     print("=" * 50)
     
-    app.run_polling(drop_pending_updates=True)
-
-if __name__ == '__main__':
-    main()
-    
-    app.run_polling(drop_pending_updates=True)
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == '__main__':
     main()
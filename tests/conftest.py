@@ -0,0 +1,13 @@
+"""
+Общие настройки тестов: бот импортируется без дневника и дискового кэша на диске разработчика.
+
+Тесты офлайн — вместо Telegram и Workflow API фейковые серверы из benchmark.py,
+вместо ONNX-модели встроенная модель dummy. Запуск: python -m pytest -q
+"""
+import os
+import sys
+
+os.environ.setdefault("DIARY_DB_PATH", "")
+os.environ.setdefault("INFERENCE_CACHE_DIR", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
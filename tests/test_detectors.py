@@ -0,0 +1,128 @@
+"""Детекторы: переключение на запасной при ошибке или пустом ответе, локальная модель dummy"""
+import asyncio
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import bot_with_photo as bot
+from benchmark import FakeWorkflowServer
+
+
+class FakeDetector:
+    """Детектор с заранее заданным ответом (результат, исключение или None)"""
+
+    streams = False
+    available = True
+    breaker = None
+
+    def __init__(self, name, answer):
+        self.name = name
+        self.answer = answer
+        self.calls = 0
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def detect(self, photo_bytes, with_visualization):
+        self.calls += 1
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return None if self.answer is None else dict(self.answer)
+
+
+def detection(*names):
+    return {"foods": [{"name": name} for name in names], "boxes": [], "visualization": None}
+
+
+def jpeg(color=(200, 60, 40), size=(96, 64)):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def test_empty_result_falls_through_to_next_detector():
+    remote, local = FakeDetector("remote", detection()), FakeDetector("local", detection("apple"))
+    router = bot.DetectorRouter([remote, local])
+    result = asyncio.run(router.detect(b"photo", False))
+    assert result["detector"] == "local"
+    assert [food["name"] for food in result["foods"]] == ["apple"]
+    assert router.stats["remote_empty"] == 1 and router.stats["local"] == 1
+
+
+def test_all_empty_returns_last_empty_result():
+    router = bot.DetectorRouter([FakeDetector("remote", detection()), FakeDetector("local", detection())])
+    result = asyncio.run(router.detect(b"photo", False))
+    assert result["foods"] == [] and result["detector"] == "local"
+
+
+def test_error_falls_through_and_first_answer_wins():
+    remote = FakeDetector("remote", bot.UpstreamError(500, "boom"))
+    local = FakeDetector("local", detection("rice"))
+    spare = FakeDetector("spare", detection("pizza"))
+    router = bot.DetectorRouter([remote, local, spare])
+    result = asyncio.run(router.detect(b"photo", False))
+    assert result["detector"] == "local"
+    assert spare.calls == 0
+    assert router.stats["remote_failed"] == 1
+
+
+def test_open_circuits_everywhere_are_reported():
+    router = bot.DetectorRouter([
+        FakeDetector("remote", bot.CircuitOpenError("remote", 12)),
+        FakeDetector("local", bot.CircuitOpenError("local", 3)),
+    ])
+    with pytest.raises(bot.CircuitOpenError):
+        asyncio.run(router.detect(b"photo", False))
+
+
+def test_open_circuit_with_failing_fallback_is_a_failure_not_an_outage():
+    router = bot.DetectorRouter([
+        FakeDetector("remote", bot.CircuitOpenError("remote", 12)),
+        FakeDetector("local", RuntimeError("модель упала")),
+    ])
+    assert asyncio.run(router.detect(b"photo", False)) is None
+
+
+def test_dummy_model_answers_offline():
+    async def main():
+        detector = bot.LocalDetector(model_path="dummy", workers=1, batch_size=4, batch_wait=0.01)
+        await detector.start()
+        try:
+            results = await asyncio.gather(*(detector.detect(jpeg(), False) for _ in range(3)))
+        finally:
+            await detector.stop()
+        return results, detector.batches
+
+    results, batches = asyncio.run(main())
+    for result in results:
+        assert len(result["foods"]) == 1 and len(result["boxes"]) == 1
+        assert result["visualization"] is None
+    # Одновременные фото прошли через модель батчами, а не по одному
+    assert sum(size * count for size, count in batches.items()) == 3
+    assert max(batches) > 1
+
+
+def test_remote_without_predictions_falls_back_to_dummy_model():
+    async def main():
+        workflow = FakeWorkflowServer(predictions=0)
+        await workflow.start()
+        bot.inference_client.url = workflow.url
+        remote = bot.RemoteDetector()
+        local = bot.LocalDetector(model_path="dummy", workers=1)
+        router = bot.DetectorRouter([remote, local])
+        await router.start()
+        try:
+            return await router.detect(jpeg(), False), workflow.requests, dict(router.stats)
+        finally:
+            await router.stop()
+            await bot.inference_client.close()
+            await workflow.stop()
+
+    result, requests, stats = asyncio.run(main())
+    assert requests == 1
+    assert result["detector"] == "local" and result["foods"]
+    assert stats == {"remote_empty": 1, "local": 1}
@@ -0,0 +1,112 @@
+"""Дневник питания: итоги дня и недели обновляются при записи, повторное фото не считается дважды"""
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+import bot_with_photo as bot
+
+UNKNOWN = [{"name": "no-such-food"}]  # продукта нет в базе — UNKNOWN_FOOD_CALORIES, без БЖУ
+
+
+def at(day, hour=12):
+    """Метка времени: понедельник 12 октября 2026 + day дней, в часовом поясе дневника"""
+    return (datetime(2026, 10, 12, hour, tzinfo=bot.DIARY_TZ) + timedelta(days=day)).timestamp()
+
+
+def with_diary(path, body, **kwargs):
+    async def main():
+        diary = bot.MealDiary(path=str(path), **kwargs)
+        await diary.start()
+        try:
+            return await body(diary)
+        finally:
+            await diary.stop()
+    return asyncio.run(main())
+
+
+def test_day_and_week_totals_are_incremental(tmp_path):
+    async def body(diary):
+        diary.record(1, at(0, 8), UNKNOWN, "a")
+        diary.record(1, at(0, 20), UNKNOWN * 2, "b")
+        diary.record(1, at(1), UNKNOWN, "c")
+        diary.record(1, at(7), UNKNOWN, "d")  # следующая неделя
+        diary.record(2, at(0), UNKNOWN, "a")  # другой пользователь
+        monday = bot.diary_day(at(0))
+        return (await diary.day_totals(1, monday), await diary.week_totals(1, bot.diary_week(monday)),
+                await diary.day_totals(1, monday + 2), dict(diary.stats))
+
+    day, (week, days), empty, stats = with_diary(tmp_path / "diary.sqlite", body)
+    calories = bot.UNKNOWN_FOOD_CALORIES
+    assert day == {"meals": 2, "calories": 3 * calories, "protein": 0, "fat": 0, "carbs": 0}
+    assert week["meals"] == 3 and week["calories"] == 4 * calories
+    monday = bot.diary_day(at(0))
+    assert days == [(monday, 2, 3 * calories), (monday + 1, 1, calories)]
+    assert empty is None
+    assert stats["written"] == 5
+
+
+def test_day_boundary_uses_diary_timezone(tmp_path):
+    async def body(diary):
+        diary.record(1, at(0, 23), UNKNOWN, "late")
+        diary.record(1, at(1, 0), UNKNOWN, "after-midnight")
+        monday = bot.diary_day(at(0))
+        return await diary.day_totals(1, monday), await diary.day_totals(1, monday + 1)
+
+    monday, tuesday = with_diary(tmp_path / "diary.sqlite", body)
+    assert monday["meals"] == 1 and tuesday["meals"] == 1
+
+
+def test_resent_photo_is_counted_once(tmp_path):
+    path = tmp_path / "diary.sqlite"
+
+    async def first(diary):
+        recorded = diary.record(1, at(0), UNKNOWN, "photo")
+        repeated = diary.record(1, at(0, 13), UNKNOWN, "photo")
+        return recorded, repeated, await diary.contains(1, at(0), "photo")
+
+    assert with_diary(path, first) == (True, False, True)
+
+    # После перезапуска о фото знает уже только база
+    async def restarted(diary):
+        # Без проверки contains() запись попадет в очередь, но писатель ее пропустит
+        queued = diary.record(1, at(0, 18), UNKNOWN, "photo")
+        totals = await diary.day_totals(1, bot.diary_day(at(0)))
+        return queued, totals, dict(diary.stats)
+
+    queued, totals, stats = with_diary(path, restarted)
+    assert queued and totals["meals"] == 1
+    assert stats["duplicates"] == 1 and stats.get("written", 0) == 0
+
+    async def lookup(diary):
+        return await diary.contains(1, at(0, 18), "photo"), await diary.contains(1, at(1), "photo")
+
+    assert with_diary(path, lookup) == (True, False)
+
+
+def test_existing_diary_gets_photo_key_column(tmp_path):
+    path = tmp_path / "diary.sqlite"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE meals (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, eaten_at REAL NOT NULL, "
+        "day INTEGER NOT NULL, foods TEXT NOT NULL, calories REAL NOT NULL, protein REAL NOT NULL, "
+        "fat REAL NOT NULL, carbs REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO meals (user_id, eaten_at, day, foods, calories, protein, fat, carbs) "
+                 "VALUES (1, 0, 1, '{}', 100, 0, 0, 0)")
+    conn.commit()
+    conn.close()
+
+    async def body(diary):
+        diary.record(1, at(0), UNKNOWN, "photo")
+        return await diary.day_totals(1, bot.diary_day(at(0)))
+
+    assert with_diary(path, body)["meals"] == 1
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM meals").fetchone()[0] == 2
+
+
+def test_disabled_diary_records_nothing():
+    diary = bot.MealDiary(path="")
+    asyncio.run(diary.start())
+    assert not diary.enabled
+    assert diary.record(1, at(0), UNKNOWN, "photo") is False
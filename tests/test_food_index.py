@@ -0,0 +1,50 @@
+"""Текстовый поиск продуктов: точные названия, поиск по началу слов, ранжирование подсказок"""
+import bot_with_photo as bot
+
+ENTRIES = [
+    ("apple", ["apple", "яблоко", "яблоки"]),
+    ("pineapple", ["pineapple", "ананас"]),
+    ("apple juice", ["apple juice", "яблочный сок"]),
+    ("green tea", ["green tea", "зелёный чай"]),
+    ("black tea", ["black tea", "черный чай"]),
+]
+
+
+def test_exact_names_in_any_language():
+    index = bot.FoodIndex(ENTRIES)
+    assert len(index) == 5
+    assert index.lookup("Яблоко") == "apple"
+    assert index.lookup("ананас!") == "pineapple"
+    # ё и е не различаются
+    assert index.lookup("зеленый чай") == "green tea"
+
+
+def test_word_prefixes_and_order_of_entries():
+    index = bot.FoodIndex(ENTRIES)
+    assert index.lookup("ябл") == "apple"  # при равенстве — продукт, который раньше в базе
+    assert index.lookup("ябл сок") == "apple juice"
+    assert index.lookup("чай") == "green tea"
+    assert index.lookup("чай черн") == "black tea"
+    assert index.lookup("кофе") is None
+
+
+def test_suggest_tolerates_typos():
+    index = bot.FoodIndex(ENTRIES)
+    assert index.suggest("ананос")[0] == "pineapple"
+    assert index.suggest("aple")[0] == "apple"
+    assert index.suggest("чорный чай")[0] == "black tea"
+    assert index.suggest("zzz") == []
+
+
+def test_suggest_ranks_word_matches_first_and_respects_limit():
+    index = bot.FoodIndex(ENTRIES)
+    suggestions = index.suggest("tea", limit=2)
+    assert suggestions == ["green tea", "black tea"]
+
+
+def test_rebuild_replaces_previous_entries():
+    index = bot.FoodIndex(ENTRIES)
+    index.build([("rice", ["rice", "рис"])])
+    assert len(index) == 1
+    assert index.lookup("рис") == "rice"
+    assert index.lookup("яблоко") is None
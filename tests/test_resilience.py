@@ -0,0 +1,131 @@
+"""Устойчивость вызовов детектора: предохранитель, бюджет повторов, повторы против фейкового Workflow API"""
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+import bot_with_photo as bot
+from benchmark import FakeWorkflowServer
+
+
+def test_breaker_opens_then_half_opens_and_closes():
+    breaker = bot.CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    with pytest.raises(bot.CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    # После паузы — ровно один пробный запрос
+    breaker.before_call()
+    assert breaker.state == breaker.HALF_OPEN
+    with pytest.raises(bot.CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    breaker.before_call()
+
+
+def test_failed_probe_opens_breaker_again():
+    breaker = bot.CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert 0 < breaker.retry_after() <= 0.05
+
+
+def test_released_probe_lets_next_call_through():
+    breaker = bot.CircuitBreaker("test", failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.release()
+    breaker.before_call()
+
+
+def test_retry_budget_is_a_share_of_requests():
+    budget = bot.RetryBudget(ratio=0.2, min_retries=1, window=60)
+    for _ in range(10):
+        budget.record_request()
+    assert [budget.try_spend() for _ in range(3)] == [True, True, False]
+
+
+def test_retry_budget_allows_minimum_at_low_traffic():
+    budget = bot.RetryBudget(ratio=0.2, min_retries=3, window=60)
+    budget.record_request()
+    assert [budget.try_spend() for _ in range(4)] == [True, True, True, False]
+
+
+def flaky_workflow(statuses):
+    """Фейковый Workflow API, который сначала отвечает статусами из statuses, потом — как обычно"""
+    workflow = FakeWorkflowServer()
+    workflow.failed = 0
+    handle = workflow._handle
+    failures = list(statuses)
+
+    async def flaky(request):
+        if failures:
+            await request.read()
+            workflow.failed += 1
+            return web.Response(status=failures.pop(0), text="busy")
+        return await handle(request)
+
+    workflow._handle = flaky
+    return workflow
+
+
+def run_remote(workflow, detector, photos=1):
+    async def main():
+        await workflow.start()
+        bot.inference_client.url = workflow.url
+        try:
+            results = []
+            for _ in range(photos):
+                try:
+                    results.append(await detector.detect(b"\xff\xd8photo", False))
+                except Exception as e:
+                    results.append(e)
+            return results
+        finally:
+            await bot.inference_client.close()
+            await workflow.stop()
+    return asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(bot, "RETRY_BACKOFF_BASE", 0.001)
+
+
+def test_transient_errors_are_retried():
+    detector = bot.RemoteDetector()
+    [result] = run_remote(flaky_workflow([503, 502]), detector)
+    assert [food["name"] for food in result["foods"]] == ["apple", "banana", "pizza"]
+    assert detector.stats["retries"] == 2
+    assert detector.breaker.state == detector.breaker.CLOSED and detector.breaker.failures == 0
+
+
+def test_client_errors_are_not_retried_and_do_not_trip_breaker():
+    detector = bot.RemoteDetector()
+    [error] = run_remote(flaky_workflow([400]), detector)
+    assert isinstance(error, bot.UpstreamError) and error.status_code == 400
+    assert detector.stats["retries"] == 0
+    assert detector.breaker.failures == 0
+
+
+def test_breaker_opens_on_repeated_failures_and_rejects_without_requests():
+    detector = bot.RemoteDetector()
+    detector.breaker = bot.CircuitBreaker("remote", failure_threshold=2, reset_timeout=60)
+    workflow = flaky_workflow([503] * 10)
+    first, second = run_remote(workflow, detector, photos=2)
+    # Третья попытка первого фото уже упирается в разомкнутый предохранитель
+    assert isinstance(first, bot.CircuitOpenError)
+    assert isinstance(second, bot.CircuitOpenError)
+    # Два ответа 503 разомкнули предохранитель — дальше запросы до сервиса не доходят
+    assert workflow.failed == 2 and workflow.requests == 0
+    assert detector.breaker.state == detector.breaker.OPEN
+    assert detector.breaker.stats["rejected"] == 2